@@ -0,0 +1,94 @@
+"""Keeps the animals API's key index (api_keys/{SHA-256 of the key}) in step with each shelter's apiKeys.
+
+Deployed with a Firestore document.written trigger on shelters/{shelterId}, so a key can be used
+without a shelterId as soon as it's created, and stops resolving as soon as it's revoked. Run this
+file directly to backfill the index from every existing shelter.
+"""
+import hashlib
+
+import functions_framework
+from google.cloud import firestore
+from google.events.cloud import firestore as firestoredata
+
+db = firestore.Client()
+
+# Firestore batches take up to 500 writes
+MAX_BATCH_WRITES = 500
+
+def hash_api_key(api_key):
+    # Must match hash_api_key in the api function
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def event_api_keys(document):
+    """Maps key hash -> key name for the apiKeys in a document from a Firestore event."""
+    if not document or 'shelterSettings' not in document.fields:
+        return {}
+    settings = document.fields['shelterSettings'].map_value.fields
+    if 'apiKeys' not in settings:
+        return {}
+    api_keys = {}
+    for value in settings['apiKeys'].array_value.values:
+        key_fields = value.map_value.fields
+        if 'key' in key_fields and key_fields['key'].string_value:
+            name = key_fields['name'].string_value if 'name' in key_fields else None
+            api_keys[hash_api_key(key_fields['key'].string_value)] = name
+    return api_keys
+
+def shelter_api_keys(shelter_data):
+    """Maps key hash -> key name for the apiKeys in a shelter doc's data."""
+    return {hash_api_key(key_obj['key']): key_obj.get('name')
+            for key_obj in (shelter_data or {}).get('shelterSettings', {}).get('apiKeys', []) if key_obj.get('key')}
+
+def write_index_changes(shelterId, added, removed):
+    """Indexes the `added` key hashes (hash -> name) for the shelter and deletes the `removed` ones."""
+    changes = [('set', key_hash, name) for key_hash, name in added.items()] + [('delete', key_hash, None) for key_hash in removed]
+    for start in range(0, len(changes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for kind, key_hash, name in changes[start:start + MAX_BATCH_WRITES]:
+            index_ref = db.collection('api_keys').document(key_hash)
+            if kind == 'set':
+                batch.set(index_ref, {'shelterId': shelterId, 'name': name, 'createdAt': firestore.SERVER_TIMESTAMP})
+            else:
+                batch.delete(index_ref)
+        batch.commit()
+
+@functions_framework.cloud_event
+def sync_api_key_index(cloud_event):
+    """Triggered when a shelter doc is created, updated or deleted."""
+    payload = firestoredata.DocumentEventData()
+    payload._pb.ParseFromString(cloud_event.data)
+
+    document_name = (payload.value or payload.old_value).name
+    shelterId = document_name.split('/')[-1]
+    old_keys = event_api_keys(payload.old_value)
+    new_keys = event_api_keys(payload.value)
+
+    added = {key_hash: name for key_hash, name in new_keys.items() if key_hash not in old_keys}
+    removed = old_keys.keys() - new_keys.keys()
+    if not added and not removed:
+        return
+    write_index_changes(shelterId, added, removed)
+    print(f"Indexed {len(added)} and removed {len(removed)} API keys for shelter {shelterId}")
+
+def backfill():
+    """Indexes every shelter's current keys and removes index entries for keys no shelter lists."""
+    indexed = {}
+    for index_doc in db.collection('api_keys').stream():
+        indexed[index_doc.id] = (index_doc.to_dict() or {}).get('shelterId')
+
+    listed = set()
+    for shelter_doc in db.collection('shelters').select(['shelterSettings.apiKeys']).stream():
+        api_keys = shelter_api_keys(shelter_doc.to_dict())
+        listed.update(api_keys)
+        missing = {key_hash: name for key_hash, name in api_keys.items() if indexed.get(key_hash) != shelter_doc.id}
+        if missing:
+            write_index_changes(shelter_doc.id, missing, [])
+            print(f"Indexed {len(missing)} API keys for shelter {shelter_doc.id}")
+
+    stale = indexed.keys() - listed
+    if stale:
+        write_index_changes(None, {}, stale)
+        print(f"Removed {len(stale)} index entries for revoked API keys")
+
+if __name__ == '__main__':
+    backfill()
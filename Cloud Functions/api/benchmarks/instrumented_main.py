@@ -0,0 +1,64 @@
+"""Load-test entry point: the animals API with its Firestore traffic counted, plus a stats endpoint.
+
+Served by run_load_test.py through functions_framework with FIRESTORE_EMULATOR_HOST set. Reads and
+writes are counted at the GAPIC layer and in the settings cache's snapshot listener, so they cover
+every code path in main. GET /__stats returns the counters, and resets them with ?reset=1.
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functions_framework
+from google.cloud.firestore_v1.services.firestore.client import FirestoreClient
+
+import main
+
+counters = {}
+counters_lock = threading.Lock()
+
+def count(name, amount=1):
+    with counters_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+def count_streamed_reads(method, field):
+    def wrapper(self, *args, **kwargs):
+        count('firestoreRpcs')
+        for response in method(self, *args, **kwargs):
+            if field in response:
+                count('firestoreReads')
+            yield response
+    return wrapper
+
+def count_writes(method):
+    def wrapper(self, *args, **kwargs):
+        count('firestoreRpcs')
+        request = kwargs.get('request', args[0] if args else None)
+        writes = request.get('writes', []) if isinstance(request, dict) else getattr(request, 'writes', [])
+        count('firestoreWrites', len(writes))
+        return method(self, *args, **kwargs)
+    return wrapper
+
+def count_listener_reads(method):
+    def wrapper(self, snapshots, changes, read_time):
+        # Every snapshot a listener receives is billed as a read, including "doesn't exist"
+        count('firestoreReads', len(snapshots) or 1)
+        count('listenerSnapshots')
+        return method(self, snapshots, changes, read_time)
+    return wrapper
+
+FirestoreClient.batch_get_documents = count_streamed_reads(FirestoreClient.batch_get_documents, 'found')
+FirestoreClient.run_query = count_streamed_reads(FirestoreClient.run_query, 'document')
+FirestoreClient.commit = count_writes(FirestoreClient.commit)
+main.CachedShelter.on_snapshot = count_listener_reads(main.CachedShelter.on_snapshot)
+
+@functions_framework.http
+def handle(request):
+    if request.path == '/__stats':
+        with counters_lock:
+            stats = dict(counters)
+            if request.args.get('reset'):
+                counters.clear()
+        return stats
+    return main.validate_api_key_and_fetch_data(request)
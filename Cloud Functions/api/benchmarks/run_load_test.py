@@ -0,0 +1,313 @@
+"""Load-tests the animals API locally, served by functions_framework against the Firestore emulator.
+
+For each shelter size, the emulator is cleared and seeded with a synthetic shelter, a second shelter
+whose rate limit is already used up, and one API key for each. Concurrent clients then send a mix
+of requests:
+
+    valid     a valid key for the seeded shelter (cats or dogs)
+    invalid   an unknown key for the same shelter
+    limited   a valid key for the rate-limited shelter
+
+Start the emulator first (`gcloud emulators firestore start --host-port=localhost:8080`), then:
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/run_load_test.py --sizes 100,1000
+
+Latency percentiles, throughput, status codes and Firestore reads/writes per request are written
+as JSON (by default to benchmarks/results/<commit>.json). Pass --baseline with an earlier results
+file to print the change in the headline numbers.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+from google.cloud import firestore
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [100, 1000, 5000]
+DEFAULT_PROJECT = 'shelterpartner-loadtest'
+KINDS = ['valid', 'invalid', 'limited']
+EXPECTED_STATUS = {'valid': {200, 304}, 'invalid': {403}, 'limited': {429}}
+COMPARED_METRICS = ['throughputRps', 'p50Ms', 'p95Ms', 'p99Ms', 'readsPerRequest', 'writesPerRequest']
+NAMES = ['Luna', 'Milo', 'Bella', 'Oliver', 'Daisy', 'Max', 'Cleo', 'Buddy', 'Nala', 'Rocky', 'Pepper', 'Ziggy']
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def clear_emulator(emulator_host, project):
+    response = requests.delete(
+        f"http://{emulator_host}/emulator/v1/projects/{project}/databases/(default)/documents", timeout=30
+    )
+    response.raise_for_status()
+
+def synthetic_animal(animal_id, species, rng, history):
+    """An animal doc shaped like the ShelterLuv sync's, with `history` notes and logs built up."""
+    intake = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(days=rng.randint(0, 365))
+    return {
+        'id': animal_id,
+        'species': species,
+        'name': rng.choice(NAMES),
+        'inKennel': rng.random() < 0.8,
+        'isActive': rng.random() < 0.9,
+        'location': f"Building {rng.randint(1, 4)}",
+        'fullLocation': f"Main Shelter>Building {rng.randint(1, 4)}>Kennel {rng.randint(1, 60)}",
+        'intakeDate': intake,
+        'updatedAt': intake,
+        'sex': rng.choice(['m', 'f']),
+        'monthsOld': rng.randint(2, 180),
+        'breed': 'Domestic Shorthair' if species == 'cat' else 'Labrador Retriever',
+        'description': ' '.join(rng.choice(NAMES) for _ in range(rng.randint(20, 80))),
+        'photos': [{'id': str(uuid.uuid4()), 'url': f"https://photos.invalid/{animal_id}.jpg",
+                    'timestamp': intake, 'author': 'Shelter Partner', 'source': 'shelterluv'}],
+        'notes': [{'id': str(uuid.uuid4()), 'timestamp': intake, 'note': 'Walked well on leash',
+                   'author': 'Volunteer'} for _ in range(history)],
+        'logs': [{'id': str(uuid.uuid4()), 'startTime': intake, 'endTime': intake, 'type': 'Walk',
+                  'author': 'Volunteer', 'earlyReason': ''} for _ in range(history)],
+    }
+
+def seed_shelter(db, shelter_id, size, api_key, rng, history, request_limit, request_count=0):
+    db.collection('shelters').document(shelter_id).set({
+        'shelterSettings': {
+            'apiKeys': [{'name': 'Load test', 'key': api_key}],
+            'requestLimit': request_limit,
+            'requestCount': request_count,
+            'lastReset': datetime.now(timezone.utc),
+        },
+        # Integrations never need these, but they make the shelter doc realistically large
+        'volunteers': [{'id': str(uuid.uuid4()), 'firstName': rng.choice(NAMES)} for _ in range(200)],
+    })
+    batch = db.batch()
+    for n in range(size):
+        species = 'cat' if n % 2 else 'dog'
+        animal_id = str(10000 + n)
+        batch.set(db.collection('shelters').document(shelter_id).collection(f"{species}s").document(animal_id),
+                  synthetic_animal(animal_id, species, rng, history))
+        if (n + 1) % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(env, port):
+    """Serves instrumented_main through functions_framework and waits until it answers."""
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'functions_framework', '--source', os.path.join(BENCHMARKS_DIR, 'instrumented_main.py'),
+         '--target', 'handle', '--host', '127.0.0.1', '--port', str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"functions_framework exited:\n{server.stderr.read()}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/__stats", timeout=1).raise_for_status()
+            return server
+        except requests.RequestException:
+            time.sleep(0.25)
+    server.kill()
+    raise RuntimeError('functions_framework did not start within 60 seconds')
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return round(sorted_values[index], 1)
+
+def latency_summary(samples):
+    latencies = sorted(sample['ms'] for sample in samples)
+    return {'p50Ms': percentile(latencies, 0.50), 'p95Ms': percentile(latencies, 0.95),
+            'p99Ms': percentile(latencies, 0.99), 'maxMs': round(latencies[-1], 1) if latencies else None}
+
+def drive(base_url, targets, args, seed):
+    """Sends args.requests requests from args.concurrency clients. Returns one sample per request."""
+    weights = [args.valid, args.invalid, args.limited]
+    plan = random.Random(seed).choices(KINDS, weights, k=args.requests)
+    next_index = iter(range(len(plan)))
+    index_lock = threading.Lock()
+    samples = []
+    samples_lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        etags = {}  # like a polling integration, revalidate what this client fetched before
+        rng = random.Random()
+        while True:
+            with index_lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            kind = plan[index]
+            target = targets[kind]
+            species = rng.choice(['cats', 'dogs'])
+            params = {'apiKey': target['apiKey'], 'species': species}
+            if not args.omit_shelter_id:
+                params['shelterId'] = target['shelterId']
+            if args.query:
+                params.update(dict(pair.split('=', 1) for pair in args.query.split('&')))
+            headers = {'Accept': args.accept, 'Accept-Encoding': args.accept_encoding}
+            if args.revalidate and (kind, species) in etags:
+                headers['If-None-Match'] = etags[(kind, species)]
+
+            started = time.perf_counter()
+            try:
+                response = session.get(base_url, params=params, headers=headers, timeout=60)
+                size = len(response.content)
+                status = response.status_code
+                if response.headers.get('ETag'):
+                    etags[(kind, species)] = response.headers['ETag']
+            except requests.RequestException:
+                status, size = 'error', 0
+            sample = {'kind': kind, 'status': status, 'bytes': size, 'ms': (time.perf_counter() - started) * 1000}
+            with samples_lock:
+                samples.append(sample)
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for _ in range(args.concurrency):
+            executor.submit(client)
+    return samples
+
+def run_scenario(size, args, env, db):
+    rng = random.Random(args.seed)
+    clear_emulator(env['FIRESTORE_EMULATOR_HOST'], env['GOOGLE_CLOUD_PROJECT'])
+    targets = {
+        'valid': {'shelterId': f"loadtest-{size}", 'apiKey': str(uuid.uuid4())},
+        'limited': {'shelterId': f"loadtest-{size}-limited", 'apiKey': str(uuid.uuid4())},
+    }
+    targets['invalid'] = {'shelterId': targets['valid']['shelterId'], 'apiKey': str(uuid.uuid4())}
+    seed_shelter(db, targets['valid']['shelterId'], size, targets['valid']['apiKey'], rng, args.history,
+                 request_limit=10 ** 9)
+    seed_shelter(db, targets['limited']['shelterId'], 10, targets['limited']['apiKey'], rng, args.history,
+                 request_limit=1, request_count=1)
+
+    port = free_port()
+    server = start_server(env, port)
+    try:
+        base_url = f"http://127.0.0.1:{port}/"
+        if args.omit_shelter_id:
+            # Keys are indexed the first time they're used with a shelterId
+            for kind in ['valid', 'limited']:
+                requests.get(base_url, params=dict(targets[kind], species='cats'), timeout=60)
+        requests.get(f"{base_url}__stats", params={'reset': 1}, timeout=10)
+
+        started = time.perf_counter()
+        samples = drive(base_url, targets, args, args.seed)
+        wall_time = time.perf_counter() - started
+        stats = requests.get(f"{base_url}__stats", timeout=10).json()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+    unexpected = [sample for sample in samples if sample['status'] not in EXPECTED_STATUS[sample['kind']]]
+    result = {
+        'requests': len(samples),
+        'wallTimeSeconds': round(wall_time, 3),
+        'throughputRps': round(len(samples) / wall_time, 1),
+        **latency_summary(samples),
+        'statuses': statuses,
+        'errorRate': round(sum(1 for sample in samples if sample['status'] == 'error'
+                               or (isinstance(sample['status'], int) and sample['status'] >= 500)) / len(samples), 4),
+        'unexpectedStatusRate': round(len(unexpected) / len(samples), 4),
+        'bytesPerRequest': round(sum(sample['bytes'] for sample in samples) / len(samples)),
+        'readsPerRequest': round(stats.get('firestoreReads', 0) / len(samples), 2),
+        'writesPerRequest': round(stats.get('firestoreWrites', 0) / len(samples), 3),
+        'firestore': stats,
+        'byKind': {},
+    }
+    for kind in KINDS:
+        kind_samples = [sample for sample in samples if sample['kind'] == kind]
+        if kind_samples:
+            result['byKind'][kind] = {'requests': len(kind_samples), **latency_summary(kind_samples)}
+    return result
+
+def print_summary(results, baseline=None):
+    header = f"{'scenario':>10} " + ' '.join(f"{metric:>18}" for metric in COMPARED_METRICS) + f" {'unexpected':>10}"
+    print(header)
+    for size, metrics in results['scenarios'].items():
+        cells = []
+        for metric in COMPARED_METRICS:
+            cell = f"{metrics[metric]}"
+            previous = ((baseline or {}).get('scenarios', {}).get(size) or {}).get(metric)
+            if previous:
+                cell += f" ({(metrics[metric] - previous) / previous:+.0%})"
+            cells.append(f"{cell:>18}")
+        print(f"{size:>10} " + ' '.join(cells) + f" {metrics['unexpectedStatusRate']:>10.2%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma-separated shelter sizes (animals across cats and dogs)')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--valid', type=float, default=0.8, help='share of requests with a valid key')
+    parser.add_argument('--invalid', type=float, default=0.1, help='share of requests with an unknown key')
+    parser.add_argument('--limited', type=float, default=0.1, help='share of requests for a rate-limited shelter')
+    parser.add_argument('--history', type=int, default=20, help='notes and logs per seeded animal')
+    parser.add_argument('--query', default='', help='extra query string, e.g. "limit=100&fields=id,name"')
+    parser.add_argument('--accept', default='application/json')
+    parser.add_argument('--accept-encoding', default='identity')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='send If-None-Match with the last ETag each client saw, like polling integrations')
+    parser.add_argument('--omit-shelter-id', action='store_true', help='authenticate with the API key alone')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    emulator_host = os.environ.get('FIRESTORE_EMULATOR_HOST')
+    if not emulator_host:
+        sys.exit('FIRESTORE_EMULATOR_HOST must point at a running Firestore emulator')
+    env = dict(os.environ)
+    env.setdefault('GOOGLE_CLOUD_PROJECT', DEFAULT_PROJECT)
+    # One worker process so the stats endpoint sees every request's Firestore traffic
+    env.update(WORKERS='1', THREADS=str(max(args.concurrency, 8)))
+    os.environ['GOOGLE_CLOUD_PROJECT'] = env['GOOGLE_CLOUD_PROJECT']
+    db = firestore.Client(project=env['GOOGLE_CLOUD_PROJECT'])
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'scenarios': {},
+    }
+    for size in (int(size) for size in args.sizes.split(',')):
+        print(f"Load testing a shelter with {size} animals...", file=sys.stderr)
+        results['scenarios'][str(size)] = run_scenario(size, args, env, db)
+
+    output = args.output or os.path.join(BENCHMARKS_DIR, 'results', f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}", file=sys.stderr)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+
+if __name__ == '__main__':
+    main()
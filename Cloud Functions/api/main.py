@@ -1,7 +1,34 @@
 import functions_framework
+from google.api_core import exceptions
 from google.cloud import firestore
-from flask import abort, jsonify, request
-from datetime import datetime, timedelta
+from flask import Response, abort, current_app, request, stream_with_context
+from werkzeug.http import http_date
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from itertools import chain
+import base64
+import binascii
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
+
+# Faster encoders and brotli are optional; without them responses fall back to Flask's JSON encoder,
+# MessagePack isn't offered and only gzip is
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 db = firestore.Client()
 
@@ -9,55 +36,433 @@ db = firestore.Client()
 DEFAULT_RATE_LIMIT = 1000
 TIME_WINDOW = timedelta(days=30)  # 1 month
 
+# Warm instances cache the settings of shelters with recent API calls. A snapshot listener keeps each
+# cached shelter current, so revoked keys stop working right away; the TTL bounds how long a stalled
+# listener could serve stale settings, and the least recently used shelters are evicted past the max.
+SETTINGS_CACHE_TTL = timedelta(seconds=int(os.environ.get('API_SETTINGS_CACHE_TTL_SECONDS', 300)))
+SETTINGS_CACHE_MAX_ENTRIES = int(os.environ.get('API_SETTINGS_CACHE_MAX_ENTRIES', 256))
+SETTINGS_CACHE_LOAD_TIMEOUT = 10  # seconds to wait for a new listener's first snapshot
+# Request counts are written with one Increment at most this often per shelter, so cached requests
+# don't each cost a write (and a listener read)
+REQUEST_COUNT_FLUSH_INTERVAL = timedelta(seconds=int(os.environ.get('API_REQUEST_COUNT_FLUSH_SECONDS', 10)))
+
+# ETags combine the per-species apiVersions counter the syncs bump with a time bucket of this many
+# seconds, so edits made in the app (which don't bump the counter) still reach clients within it
+API_ETAG_MAX_AGE = int(os.environ.get('API_ETAG_MAX_AGE_SECONDS', 300))
+
+# Pagination and projection: `limit` caps a page (the next page's token is returned in the
+# X-Next-Page-Token header) and `fields` selects top-level or dotted field paths
+API_MAX_PAGE_SIZE = 500
+API_MAX_FIELDS = 50
+# Filters: equality on these fields, plus at most one of the date ranges. The composite indexes
+# they need are in firestore.indexes.json, deployed through firebase.json (see README.md).
+BOOLEAN_FILTERS = ['isActive', 'inKennel']
+EQUALITY_FILTERS = ['location', 'sex']
+RANGE_FILTERS = {
+    'intakeAfter': ('intakeDate', '>='),
+    'intakeBefore': ('intakeDate', '<'),
+    # updatedAt is only set by the ShelterLuv API sync when it changes an animal, so animals of
+    # email-ingest shelters, and ones the sync hasn't changed, never match
+    'updatedSince': ('updatedAt', '>='),
+}
+# Streamed responses are flushed in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+# Response formats, negotiated on Accept. NDJSON and MessagePack bodies are a sequence of one
+# object per animal rather than an array, so they can be decoded as they stream in.
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+# Compression, negotiated on Accept-Encoding
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+FIELD_PATH_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
 def to_datetime(firestore_timestamp):
     return datetime.fromtimestamp(firestore_timestamp.timestamp())
 
-def check_and_update_rate_limit(shelterId):
-    now = datetime.utcnow()
-    shelterRef = db.collection('shelters').document(shelterId)
-    shelterDoc = shelterRef.get()
-    
-    if not shelterDoc.exists:
-        return False, 'Shelter not found'
-    
-    shelterData = shelterDoc.to_dict()
-    
-    # Accessing shelterSettings map
-    shelterSettings = shelterData.get('shelterSettings', {})
-    if not shelterSettings:
-        return False, 'shelterSettings not found'
-
-    requestCount = shelterSettings.get('requestCount', 0)
-    lastReset = shelterSettings.get('lastReset')
-    requestLimit = shelterSettings.get('requestLimit', DEFAULT_RATE_LIMIT)
-
-    if lastReset:
-        lastReset = to_datetime(lastReset)  # Convert Firestore timestamp to standard datetime
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+class CachedShelter:
+    """A shelter's settings as last seen by its snapshot listener, plus requests not yet written."""
+
+    def __init__(self, shelterRef, now):
+        self.shelterRef = shelterRef
+        self.expires_at = now + SETTINGS_CACHE_TTL
+        self.exists = False
+        self.settings = {}
+        self.api_keys = {}  # key hash -> apiKeys entry
+        self.api_versions = {}  # species -> version bumped by the syncs
+        self.pending = 0
+        # The first request after a quiet spell is written straight away, since an idle instance may be
+        # recycled before a later flush runs; requests that follow within the interval are batched
+        self.last_flush = datetime.min
+        self._flush_timer = None
+        self.loaded = threading.Event()
+        self.watch = None
+        self._lock = threading.Lock()
+
+    def on_snapshot(self, snapshots, changes, read_time):
+        # A document watch passes an empty list while the document doesn't exist
+        snapshot = snapshots[0] if snapshots else None
+        with self._lock:
+            self.exists = snapshot is not None and snapshot.exists
+            shelterData = (snapshot.to_dict() or {}) if self.exists else {}
+            self.settings = shelterData.get('shelterSettings', {})
+            self.api_versions = shelterData.get('apiVersions', {})
+            self.api_keys = {hash_api_key(key_obj['key']): key_obj
+                             for key_obj in self.settings.get('apiKeys', []) if key_obj.get('key')}
+            if not self.exists:
+                self.expires_at = datetime.min
+        self.loaded.set()
+
+    def check_request(self, key_hash, now):
+        """Validates the API key and rate limit against the cached settings and counts the request.
+
+        Returns (status code, error message), or (None, None) if the request may go ahead. Requests
+        rejected for any reason are not counted.
+        """
+        with self._lock:
+            if not self.exists:
+                return 404, 'Shelter not found'
+
+            shelterSettings = self.settings
+            if not shelterSettings:
+                return 404, 'shelterSettings not found'
+
+            if key_hash not in self.api_keys:
+                return 403, 'Invalid API Key'
+
+            lastReset = shelterSettings.get('lastReset')
+            requestLimit = shelterSettings.get('requestLimit', DEFAULT_RATE_LIMIT)
+
+            # Check if we need to reset the count (new month)
+            reset = not lastReset or now - to_datetime(lastReset) >= TIME_WINDOW
+            requestCount = 0 if reset else shelterSettings.get('requestCount', 0) + self.pending
+
+            # Check if the request count exceeds the rate limit
+            if requestCount >= requestLimit:
+                return 429, 'Rate limit exceeded'
+
+            self.pending += 1
+            if not reset and now - self.last_flush < REQUEST_COUNT_FLUSH_INTERVAL:
+                if self._flush_timer is None:
+                    # Write the burst's trailing requests once the interval is up, even if no request follows
+                    delay = (self.last_flush + REQUEST_COUNT_FLUSH_INTERVAL - now).total_seconds()
+                    self._flush_timer = threading.Timer(delay, self.flush_pending)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return None, None
+
+            if reset:
+                update = {'shelterSettings.requestCount': self.pending, 'shelterSettings.lastReset': now}
+                self.settings = dict(shelterSettings, requestCount=self.pending, lastReset=now)
+            else:
+                # Increment so counts flushed by other instances aren't overwritten
+                update = {'shelterSettings.requestCount': firestore.Increment(self.pending)}
+                self.settings = dict(shelterSettings, requestCount=requestCount + 1)
+            if 'requestLimit' not in shelterSettings:
+                # Add rate limit field only if it doesn't exist
+                update['shelterSettings.requestLimit'] = DEFAULT_RATE_LIMIT
+            pending, self.pending = self.pending, 0
+            self.last_flush = now
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        try:
+            self.shelterRef.update(update)
+        except Exception:
+            with self._lock:
+                self.pending += pending
+            raise
+        return None, None
+
+    def etag(self, species, variant=''):
+        """Weak ETag for a species; `variant` distinguishes pages and projections of the same version."""
+        version = f"{species}-{self.api_versions.get(species, 0)}-{int(time.time() // API_ETAG_MAX_AGE)}"
+        if variant:
+            version += '-' + hashlib.sha256(variant.encode('utf-8')).hexdigest()[:12]
+        return version
+
+    def flush_pending(self):
+        """Writes any requests counted since the last flush."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            pending, self.pending = self.pending, 0
+            if pending:
+                self.settings = dict(self.settings, requestCount=self.settings.get('requestCount', 0) + pending)
+                self.last_flush = datetime.utcnow()
+        if pending:
+            try:
+                self.shelterRef.update({'shelterSettings.requestCount': firestore.Increment(pending)})
+            except Exception as e:
+                print(f'Error flushing request count for shelter {self.shelterRef.id}: {e}')
+                with self._lock:
+                    self.pending += pending
+
+    def close(self):
+        """Stops listening and writes any requests counted since the last flush."""
+        if self.watch is not None:
+            self.watch.unsubscribe()
+        self.flush_pending()
+
+class ShelterSettingsCache:
+    """Bounded LRU of CachedShelter entries, keyed by shelter ID."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shelterId, now):
+        """Returns the cached shelter, loading it (and starting its listener) on a miss or after the TTL."""
+        with self._lock:
+            entry = self._entries.get(shelterId)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(shelterId)
+                return entry
+        if entry is not None:
+            self._discard(shelterId, entry)
+
+        entry = CachedShelter(db.collection('shelters').document(shelterId), now)
+        # The listener's first snapshot doubles as the read that loads the settings
+        entry.watch = entry.shelterRef.on_snapshot(entry.on_snapshot)
+        if not entry.loaded.wait(SETTINGS_CACHE_LOAD_TIMEOUT):
+            entry.close()
+            raise TimeoutError(f'Timed out loading settings for shelter {shelterId}')
+        if not entry.exists:
+            # Don't hold a listener open for shelters that don't exist
+            entry.close()
+            return entry
+
+        evicted = []
+        with self._lock:
+            replaced = self._entries.pop(shelterId, None)
+            if replaced is not None:
+                evicted.append(replaced)
+            self._entries[shelterId] = entry
+            while len(self._entries) > SETTINGS_CACHE_MAX_ENTRIES:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for evicted_entry in evicted:
+            evicted_entry.close()
+        return entry
+
+    def _discard(self, shelterId, entry):
+        with self._lock:
+            if self._entries.get(shelterId) is entry:
+                del self._entries[shelterId]
+        entry.close()
+
+class ApiKeyIndex:
+    """Resolves API keys to their shelter through api_keys/{SHA-256 of the key}.
+
+    The index is maintained by the api-key-index function as keys are created and revoked. Keys used
+    with an explicit shelterId are also added here, and entries whose shelter no longer lists the key
+    are removed, so the index heals if a trigger is missed. The shelter's settings stay the source of
+    truth for valid keys.
+    """
+
+    def __init__(self):
+        self._shelter_ids = OrderedDict()  # key hash -> shelter ID, for keys this instance has seen
+        self._lock = threading.Lock()
+
+    def _remember(self, key_hash, shelterId):
+        with self._lock:
+            self._shelter_ids[key_hash] = shelterId
+            self._shelter_ids.move_to_end(key_hash)
+            while len(self._shelter_ids) > SETTINGS_CACHE_MAX_ENTRIES:
+                self._shelter_ids.popitem(last=False)
+
+    def lookup(self, key_hash):
+        with self._lock:
+            shelterId = self._shelter_ids.get(key_hash)
+        if shelterId:
+            return shelterId
+        snapshot = db.collection('api_keys').document(key_hash).get()
+        shelterId = (snapshot.to_dict() or {}).get('shelterId') if snapshot.exists else None
+        if shelterId:
+            self._remember(key_hash, shelterId)
+        return shelterId
+
+    def add(self, key_hash, shelterId, name):
+        with self._lock:
+            if self._shelter_ids.get(key_hash) == shelterId:
+                return
+        try:
+            db.collection('api_keys').document(key_hash).create({
+                'shelterId': shelterId,
+                'name': name,
+                'createdAt': firestore.SERVER_TIMESTAMP
+            })
+        except exceptions.AlreadyExists:
+            pass
+        self._remember(key_hash, shelterId)
+
+    def remove(self, key_hash):
+        with self._lock:
+            self._shelter_ids.pop(key_hash, None)
+        db.collection('api_keys').document(key_hash).delete()
+
+def parse_page_params(args):
+    """Reads limit, pageToken and fields from the query string. Raises ValueError if any are invalid."""
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 1 <= int(limit) <= API_MAX_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {API_MAX_PAGE_SIZE}')
+        limit = int(limit)
+
+    cursor = None
+    page_token = args.get('pageToken')
+    if page_token:
+        try:
+            cursor = base64.urlsafe_b64decode(page_token + '=' * (-len(page_token) % 4)).decode('utf-8')
+        except (binascii.Error, UnicodeError):
+            raise ValueError('Invalid pageToken')
+        if not cursor or '/' in cursor:
+            raise ValueError('Invalid pageToken')
+
+    fields = None
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        if len(fields) > API_MAX_FIELDS or not all(FIELD_PATH_PATTERN.match(field) for field in fields):
+            raise ValueError(f'fields must be up to {API_MAX_FIELDS} comma-separated field paths')
+    return limit, cursor, fields
+
+def parse_filters(args):
+    """Reads the filter parameters into (field, op, value) where clauses, plus the range field if any.
+
+    Raises ValueError if any are invalid.
+    """
+    filters = []
+    for field in BOOLEAN_FILTERS:
+        if field in args:
+            if args[field] not in ('true', 'false'):
+                raise ValueError(f'{field} must be true or false')
+            filters.append((field, '==', args[field] == 'true'))
+    for field in EQUALITY_FILTERS:
+        if args.get(field):
+            filters.append((field, '==', args[field]))
+
+    range_field = None
+    for param, (field, op) in RANGE_FILTERS.items():
+        if not args.get(param):
+            continue
+        if range_field and range_field != field:
+            raise ValueError('Only one of intakeAfter/intakeBefore or updatedSince can be used at a time')
+        try:
+            value = datetime.fromisoformat(args[param].replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f'{param} must be an ISO 8601 date or time')
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        filters.append((field, op, value))
+        range_field = field
+    return filters, range_field
+
+def encode_page_token(doc_id):
+    # Unpadded so the token can go in a query string as is
+    return base64.urlsafe_b64encode(doc_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def encode_firestore_value(value):
+    """`default` hook for the Firestore types the encoders don't handle themselves."""
+    if isinstance(value, datetime):
+        # Same format jsonify used
+        return http_date(value)
+    if isinstance(value, firestore.GeoPoint):
+        return {'latitude': value.latitude, 'longitude': value.longitude}
+    if isinstance(value, firestore.DocumentReference):
+        return value.path
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+def encode_msgpack_value(value):
+    if isinstance(value, datetime):
+        # Firestore's datetime subclass isn't packed natively, so use the MessagePack timestamp type
+        return msgpack.Timestamp.from_datetime(value)
+    return encode_firestore_value(value)
+
+def json_encoder():
+    if orjson is not None:
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return lambda data: orjson.dumps(data, default=encode_firestore_value, option=options)
+    # Same encoder and compact separators as jsonify
+    dumps = current_app.json.dumps
+    return lambda data: dumps(data, separators=(',', ':'), default=encode_firestore_value).encode('utf-8')
+
+def negotiate_mimetype(accept_mimetypes):
+    offered = [JSON_MIMETYPE, NDJSON_MIMETYPE] + (MSGPACK_MIMETYPES if msgpack is not None else [])
+    mimetype = accept_mimetypes.best_match(offered, default=JSON_MIMETYPE)
+    return MSGPACK_MIMETYPES[0] if mimetype in MSGPACK_MIMETYPES else mimetype
+
+def negotiate_encoding(accept_encodings):
+    return accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+def encode_animals(docs, mimetype):
+    """Encodes documents as they arrive, as a JSON array or as a sequence of NDJSON lines or MessagePack objects."""
+    if mimetype == JSON_MIMETYPE or mimetype == NDJSON_MIMETYPE:
+        dumps = json_encoder()
     else:
-        lastReset = now
+        packer = msgpack.Packer(default=encode_msgpack_value)
+        dumps = lambda data: packer.pack(data)
+    buffer = [b'['] if mimetype == JSON_MIMETYPE else []
+    size = 0
+    for index, doc in enumerate(docs):
+        encoded = dumps(doc.to_dict())
+        if mimetype == JSON_MIMETYPE and index:
+            buffer.append(b',')
+        elif mimetype == NDJSON_MIMETYPE:
+            encoded += b'\n'
+        buffer.append(encoded)
+        size += len(encoded)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if mimetype == JSON_MIMETYPE:
+        buffer.append(b']')
+    yield b''.join(buffer)
 
-    # Check if we need to reset the count (new month)
-    if now - lastReset >= TIME_WINDOW:
-        requestCount = 0
-        lastReset = now
+def compress_stream(chunks, encoding):
+    """Compresses a stream of chunks incrementally with gzip or brotli."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
 
-    # Check if the request count exceeds the rate limit
-    if requestCount >= requestLimit:
-        return False, 'Rate limit exceeded'
+settings_cache = ShelterSettingsCache()
+api_key_index = ApiKeyIndex()
 
-    # Update the request count and last reset timestamp only if they exist
-    shelterRef.update({
-        'shelterSettings.requestCount': requestCount + 1,
-        'shelterSettings.lastReset': lastReset
-    })
+def check_api_key_and_rate_limit(shelterId, api_key):
+    """Validates the API key and rate limit from the shelter's cached settings, then counts the request.
 
-    if 'requestLimit' not in shelterSettings:
-        # Add rate limit field only if it doesn't exist
-        shelterRef.update({
-            'shelterSettings.requestLimit': DEFAULT_RATE_LIMIT
-        })
+    Without a shelterId the key is resolved through the key index. Returns (cached shelter, status
+    code, error message); the status code is None if the request may go ahead.
+    """
+    now = datetime.utcnow()
+    key_hash = hash_api_key(api_key)
+    resolved = not shelterId
+    if resolved:
+        shelterId = api_key_index.lookup(key_hash)
+        if not shelterId:
+            return None, 403, 'Invalid API Key'
 
-    return True, None
+    entry = settings_cache.get(shelterId, now)
+    status_code, error_message = entry.check_request(key_hash, now)
+    if resolved and status_code in (403, 404):
+        # The key was revoked or its shelter deleted since it was indexed
+        api_key_index.remove(key_hash)
+    elif not resolved and status_code in (None, 429):
+        api_key_index.add(key_hash, shelterId, entry.api_keys.get(key_hash, {}).get('name'))
+    return entry, status_code, error_message
 
 @functions_framework.http
 def validate_api_key_and_fetch_data(request):
@@ -65,43 +470,94 @@ def validate_api_key_and_fetch_data(request):
     api_key = request.args.get('apiKey')
     species = request.args.get('species')
 
-    if not shelterId or not api_key or not species:
-        return abort(400, 'Missing shelterId, apiKey, or species')
+    # shelterId is optional; without it the shelter is looked up from the API key
+    if not api_key or not species:
+        return abort(400, 'Missing apiKey or species')
 
     if species not in ['dogs', 'cats']:
         return abort(400, 'Invalid species. Must be "dogs" or "cats"')
 
-    # Check and update rate limit
-    rate_limit_ok, error_message = check_and_update_rate_limit(shelterId)
-    if not rate_limit_ok:
-        return abort(429, error_message)
-
     try:
-        shelterRef = db.collection('shelters').document(shelterId)
-        shelterDoc = shelterRef.get()
-        if not shelterDoc.exists:
-            return abort(404, 'Shelter not found')
+        limit, cursor, fields = parse_page_params(request.args)
+        filters, range_field = parse_filters(request.args)
+    except ValueError as e:
+        return abort(400, str(e))
 
-        # Access shelterSettings to validate API key
-        shelterData = shelterDoc.to_dict()
-        shelterSettings = shelterData.get('shelterSettings', {})
-        
-        if not shelterSettings:
-            return abort(404, 'shelterSettings not found')
-
-        # Access the keys within shelterSettings
-        apiKeys = shelterSettings.get('apiKeys', [])
-        is_valid_api_key = any(key_obj['key'] == api_key for key_obj in apiKeys)
+    try:
+        shelter, status_code, error_message = check_api_key_and_rate_limit(shelterId, api_key)
+    except Exception as e:
+        print(f'Error validating API key: {e}')
+        return abort(500, 'Internal Server Error')
+    if status_code:
+        return abort(status_code, error_message)
 
-        if not is_valid_api_key:
-            return abort(403, 'Invalid API Key')
+    # Answer from the cached shelter doc alone when the client already has this version
+    mimetype = negotiate_mimetype(request.accept_mimetypes)
+    encoding = negotiate_encoding(request.accept_encodings)
 
-        # Fetch the data from the specified subcollection (Dogs or Cats)
-        animals_ref = shelterRef.collection(species)
-        animals = [doc.to_dict() for doc in animals_ref.stream()]
+    # Weak ETags are shared across compressions of the same body, but not across formats
+    variant = [f"{key}={value}" for key, value in sorted(request.args.items(multi=True))
+               if key not in ('shelterId', 'apiKey', 'species')]
+    etag = shelter.etag(species, '&'.join(variant + ([mimetype] if mimetype != JSON_MIMETYPE else [])))
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        try:
+            # Fetch the data from the specified subcollection (Dogs or Cats)
+            animals_ref = shelter.shelterRef.collection(species)
+            query = animals_ref
+            for field, op, value in filters:
+                query = query.where(filter=firestore.FieldFilter(field, op, value))
+            if fields:
+                query = query.select(fields)
+            if (limit or cursor) and range_field:
+                # Firestore orders range queries by the range field first, so the cursor needs that
+                # field's value too and starts after the last document's snapshot
+                query = query.order_by(range_field).order_by('__name__')
+                if cursor:
+                    cursor_snapshot = animals_ref.document(cursor).get()
+                    if not cursor_snapshot.exists:
+                        raise ValueError('Invalid pageToken')
+                    query = query.start_after(cursor_snapshot)
+            elif limit or cursor:
+                # Paging follows document ID order, so the cursor is just the last ID returned
+                query = query.order_by('__name__')
+                if cursor:
+                    query = query.start_after({'__name__': cursor})
+            if limit:
+                # One extra document tells us whether there's another page
+                query = query.limit(limit + 1)
+            next_page_token = None
+            if limit:
+                # A page is small, and its token has to be known before the headers are sent
+                docs = list(query.stream())
+                if len(docs) > limit:
+                    docs = docs[:limit]
+                    next_page_token = encode_page_token(docs[-1].id)
+            else:
+                # Stream whole collections so memory stays flat and the first bytes go out early.
+                # Reading the first document here means a failed query still gets a 500.
+                docs = query.stream()
+                first_doc = next(docs, None)
+                docs = chain([first_doc], docs) if first_doc is not None else iter([])
 
-        return jsonify(animals)
+            body = encode_animals(docs, mimetype)
+            if encoding:
+                body = compress_stream(body, encoding)
+            response = Response(stream_with_context(body), mimetype=mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            if next_page_token:
+                response.headers['X-Next-Page-Token'] = next_page_token
+        except ValueError as e:
+            return abort(400, str(e))
+        except Exception as e:
+            print(f'Error fetching data: {e}')
+            return abort(500, 'Internal Server Error')
 
-    except Exception as e:
-        print(f'Error validating API key or fetching data: {e}')
-        return abort(500, 'Internal Server Error')
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    # Clients must revalidate, which costs them a 304 at most
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,77 @@
+"""Unit tests for the animals API. Run with `python -m pytest` from this directory."""
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+
+with mock.patch('google.cloud.firestore.Client'):
+    import main
+
+API_KEY = 'test-key'
+
+def cached_shelter(now, **settings):
+    """A CachedShelter loaded with one API key and the given shelterSettings fields."""
+    shelter = main.CachedShelter(mock.Mock(id='S'), now)
+    data = {'shelterSettings': dict({'apiKeys': [{'key': API_KEY, 'name': 'Website'}]}, **settings)}
+    shelter.on_snapshot([DocumentSnapshot(shelter.shelterRef, data, True, None, None, None)], [], None)
+    return shelter
+
+class CheckRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.utcnow()
+        self.key_hash = main.hash_api_key(API_KEY)
+
+    def test_first_request_of_an_interval_is_written_immediately(self):
+        shelter = cached_shelter(self.now, requestCount=3, requestLimit=10, lastReset=self.now - timedelta(days=1))
+
+        self.assertEqual(shelter.check_request(self.key_hash, self.now), (None, None))
+
+        shelter.shelterRef.update.assert_called_once_with({'shelterSettings.requestCount': firestore.Increment(1)})
+        self.assertEqual((shelter.settings['requestCount'], shelter.pending), (4, 0))
+        shelter.close()
+
+    def test_trailing_requests_of_a_burst_are_flushed_by_the_timer(self):
+        shelter = cached_shelter(self.now, requestCount=3, requestLimit=10, lastReset=self.now - timedelta(days=1))
+        flushed = threading.Event()
+        # The first update is the burst's first request; the second is the timer's flush
+        shelter.shelterRef.update.side_effect = lambda update: flushed.set() if shelter.shelterRef.update.call_count == 2 else None
+
+        with mock.patch.object(main, 'REQUEST_COUNT_FLUSH_INTERVAL', timedelta(milliseconds=50)):
+            for _ in range(3):
+                self.assertEqual(shelter.check_request(self.key_hash, self.now), (None, None))
+            self.assertEqual((shelter.shelterRef.update.call_count, shelter.pending), (1, 2))
+
+            self.assertTrue(flushed.wait(5))
+
+        self.assertEqual(shelter.shelterRef.update.call_args_list, [
+            mock.call({'shelterSettings.requestCount': firestore.Increment(1)}),
+            mock.call({'shelterSettings.requestCount': firestore.Increment(2)}),
+        ])
+        self.assertEqual((shelter.settings['requestCount'], shelter.pending), (6, 0))
+        shelter.close()
+
+    def test_count_is_reset_once_the_window_has_passed(self):
+        shelter = cached_shelter(self.now, requestCount=10, requestLimit=10, lastReset=self.now - main.TIME_WINDOW)
+
+        self.assertEqual(shelter.check_request(self.key_hash, self.now), (None, None))
+
+        shelter.shelterRef.update.assert_called_once_with({'shelterSettings.requestCount': 1,
+                                                           'shelterSettings.lastReset': self.now})
+        self.assertEqual((shelter.settings['requestCount'], shelter.settings['lastReset']), (1, self.now))
+        shelter.close()
+
+    def test_rejected_requests_are_not_written(self):
+        shelter = cached_shelter(self.now, requestCount=10, requestLimit=10, lastReset=self.now - timedelta(days=1))
+
+        self.assertEqual(shelter.check_request(main.hash_api_key('revoked-key'), self.now), (403, 'Invalid API Key'))
+        self.assertEqual(shelter.check_request(self.key_hash, self.now), (429, 'Rate limit exceeded'))
+        shelter.close()
+
+        shelter.shelterRef.update.assert_not_called()
+        self.assertIsNone(shelter._flush_timer)
+
+if __name__ == '__main__':
+    unittest.main()
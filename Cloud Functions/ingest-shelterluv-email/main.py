@@ -6,12 +6,16 @@ import email
 import os
 import re
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
 from google.api_core import exceptions
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import timezone 
 import pandas as pd
 import ast
+import threading
+import time
+import uuid
 
 # Initialize Firestore client
 print("[DEBUG] Initializing Firestore client...")
@@ -20,6 +24,17 @@ print("[DEBUG] Firestore client initialized successfully.")
 
 print("[DEBUG] Firestore project id:", db.project)
 
+# BulkWriter throughput and per-document retry settings
+SYNC_WRITER_INITIAL_OPS_PER_SECOND = int(os.environ.get('SYNC_WRITER_INITIAL_OPS_PER_SECOND', 1000))
+SYNC_WRITER_MAX_OPS_PER_SECOND = int(os.environ.get('SYNC_WRITER_MAX_OPS_PER_SECOND', 5000))
+SYNC_WRITER_MAX_ATTEMPTS = 10
+# gRPC codes worth retrying: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+RETRYABLE_WRITE_CODES = {4, 8, 10, 13, 14}
+
+# Sync lease: how long a lease lasts without renewal, and how many processed message IDs are kept
+SYNC_LEASE_TTL = timedelta(seconds=int(os.environ.get('SYNC_LEASE_TTL_SECONDS', 120)))
+SYNC_LEASE_RECENT_MESSAGES = 20
+
 @functions_framework.cloud_event
 def shelterluv_sync(cloud_event):
     """
@@ -32,6 +47,8 @@ def shelterluv_sync(cloud_event):
     
     shelter_id = None  # Initialize shelter_id at the start
     print("[DEBUG] shelter_id variable initialized to None.")
+    lease = None
+    message_id = None
 
     try:
         print("[DEBUG] Attempting to retrieve pubsub_message from cloud_event data...")
@@ -106,16 +123,6 @@ def shelterluv_sync(cloud_event):
         shelter_ref = db.collection('shelters').document(shelter_id)
         shelter_snapshot = shelter_ref.get()
 
-        if email_date:
-            print("[DEBUG] Storing email sync date in Firestore...")
-            try:
-                shelter_ref.update({"lastEmailSync": email_date})
-                shelter_ref.update({"lastEmailSyncTime": email_date})
-                print("[DEBUG] Last sync date stored successfully in Firestore.")
-            except exceptions.GoogleCloudError as e_firestore:
-                print(f"[DEBUG] Error updating Firestore with lastSync date: {e_firestore}")
-
-        
         if not shelter_snapshot.exists:
             print(f"[DEBUG] Shelter doc '{shelter_id}' not found in Firestore. Exiting.")
             return
@@ -165,10 +172,16 @@ def shelterluv_sync(cloud_event):
         # ---------------------------
         # Searching emails
         # ---------------------------
+        # UIDs only increase within a UIDVALIDITY, so only reports newer than the last one we
+        # ingested need to be searched; a new UIDVALIDITY means the old UIDs are meaningless.
+        uid_validity = mailbox_uid_validity(mail)
+        last_uid = last_ingested_uid(shelter_data, uid_validity)
+        print(f"[DEBUG] Mailbox UIDVALIDITY: {uid_validity}, last ingested UID: {last_uid}")
+
         print(f"[DEBUG] We will now search for emails with subject containing '{short_uuid}'.")
         subject_search = short_uuid
         print(f"[DEBUG] Executing mail.uid search with subject_search: {subject_search}")
-        result, data = mail.uid('search', None, f'(SUBJECT "{subject_search}")')
+        result, data = mail.uid('search', None, f'(UID {last_uid + 1}:* SUBJECT "{subject_search}")')
         print(f"[DEBUG] search result: {result}, raw data: {data}")
 
         if result != 'OK':
@@ -176,17 +189,35 @@ def shelterluv_sync(cloud_event):
             return
 
         print("[DEBUG] Splitting email_ids from data.")
-        email_ids = data[0].split()
-        print(f"[DEBUG] Found {len(email_ids)} matching email(s). email_ids: {email_ids}")
+        # "n:*" still matches the newest message when n is past it, so filter out what we've seen
+        email_ids = [uid for uid in data[0].split() if int(uid) > last_uid]
+        print(f"[DEBUG] Found {len(email_ids)} new matching email(s). email_ids: {email_ids}")
 
         if not email_ids:
-            print(f"[DEBUG] No emails found using shortUUID '{short_uuid}'. Exiting function.")
+            print(f"[DEBUG] No new emails found using shortUUID '{short_uuid}'. Exiting function.")
             return
         
+        # Only one email sync per shelter at a time, and never twice for the same Pub/Sub message
+        message_id = pubsub_message.get("messageId") or pubsub_message.get("message_id") or cloud_event["id"]
+        lease = SyncLease(db, shelter_ref, 'shelterluv_email')
+        lease_status = lease.acquire(message_id)
+        print(f"[DEBUG] Sync lease for message {message_id}: {lease_status}")
+        if lease_status == 'duplicate':
+            print(f"[DEBUG] Message {message_id} was already processed. Exiting function.")
+            return
+        if lease_status == 'held':
+            print(f"[DEBUG] An email sync for shelter {shelter_id} is already running. Exiting function.")
+            return
+
         # ---------------------------
         # Processing the latest email
         # ---------------------------
         latest_email_uid = email_ids[-1]
+        # Another invocation may have ingested this report between our search and taking the lease
+        ingested = shelter_ref.get(field_paths=['emailSyncUidValidity', 'emailSyncLastUid']).to_dict() or {}
+        if last_ingested_uid(ingested, uid_validity) >= int(latest_email_uid):
+            print(f"[DEBUG] Email UID {latest_email_uid} was already ingested. Exiting function.")
+            return
         print(f"[DEBUG] Latest email UID is: {latest_email_uid}")
         print("[DEBUG] Fetching the latest email data...")
         result, email_data = mail.uid('fetch', latest_email_uid, '(BODY[])')
@@ -278,8 +309,9 @@ def shelterluv_sync(cloud_event):
         dogs_ref = shelter_ref.collection('dogs')
 
         print("[DEBUG] Starting sync_df_to_firestore...")
-        sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id)
+        sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id, lease)
         print("[DEBUG] sync_df_to_firestore completed.")
+        lease.ensure_held()
 
         # ---------------------------
         # Updating Firestore timestamps
@@ -290,7 +322,13 @@ def shelterluv_sync(cloud_event):
                 "lastEmailSync": firestore.SERVER_TIMESTAMP,
                 "lastEmailSyncTime": firestore.SERVER_TIMESTAMP,
                 "lastCatEmailSync": firestore.SERVER_TIMESTAMP,
-                "lastDogEmailSync": firestore.SERVER_TIMESTAMP
+                "lastDogEmailSync": firestore.SERVER_TIMESTAMP,
+                # Every animal in the report was rewritten, so the animals API's ETags must change
+                "apiVersions.cats": firestore.Increment(1),
+                "apiVersions.dogs": firestore.Increment(1),
+                # High-water mark that lets the next run skip this report
+                "emailSyncUidValidity": uid_validity,
+                "emailSyncLastUid": int(latest_email_uid)
             }
             shelter_ref.update(update_data)
             print("[DEBUG] shelter_ref.update() completed successfully.")
@@ -300,12 +338,17 @@ def shelterluv_sync(cloud_event):
                 "lastEmailSync": firestore.SERVER_TIMESTAMP,
                 "lastEmailSyncTime": firestore.SERVER_TIMESTAMP,
                 "lastCatEmailSync": firestore.SERVER_TIMESTAMP,
-                "lastDogEmailSync": firestore.SERVER_TIMESTAMP
+                "lastDogEmailSync": firestore.SERVER_TIMESTAMP,
+                "emailSyncUidValidity": uid_validity,
+                "emailSyncLastUid": int(latest_email_uid)
             })
             print("[DEBUG] shelter_ref.set() completed successfully.")
 
         print(f"[DEBUG] Successfully processed ShelterLuv sync for shelter: {shelter_id}, shortUUID='{short_uuid}'")
 
+    except LeaseLostError as e:
+        # The invocation that took over the lease finishes the sync, so there's nothing to retry
+        print(f"[DEBUG] Stopped email sync for shelter {shelter_id}: {e}")
     except Exception as e:
         error_message = f"Error processing ShelterLuv sync"
 
@@ -313,8 +356,14 @@ def shelterluv_sync(cloud_event):
             error_message += f" for shelter {shelter_id}"
         error_message += f": {str(e)}"
         print(f"[DEBUG] {error_message}")
+        if lease:
+            # Release without recording the message, so a redelivery can retry the sync
+            lease.release()
         raise e
     finally:
+        if lease and not lease.released:
+            print("[DEBUG] Releasing sync lease...")
+            lease.release(message_id)
         # Attempting to close email connection if it exists
         if 'mail' in locals():
             print("[DEBUG] Attempting to close IMAP connection...")
@@ -325,6 +374,19 @@ def shelterluv_sync(cloud_event):
             except Exception as e_mail:
                 print(f"[DEBUG] Exception while closing/logging out of mail: {e_mail}")
 
+def mailbox_uid_validity(mail):
+    """Returns the selected mailbox's UIDVALIDITY, or None if the server didn't report one."""
+    result, data = mail.response('UIDVALIDITY')
+    if result != 'UIDVALIDITY' or not data or data[0] is None:
+        return None
+    return int(data[0])
+
+def last_ingested_uid(state, uid_validity):
+    """The last ingested report's UID, or 0 if none was recorded under this UIDVALIDITY."""
+    if uid_validity is None or state.get('emailSyncUidValidity') != uid_validity:
+        return 0
+    return state.get('emailSyncLastUid', 0)
+
 def download_file_from_link(link, destination_path):
     """Download a file from the provided link to the specified destination path."""
     print(f"[DEBUG] download_file_from_link called with link='{link}', destination_path='{destination_path}'")
@@ -339,7 +401,175 @@ def download_file_from_link(link, destination_path):
         print(f"[DEBUG] {error_msg}")
         raise Exception(error_msg)
 
-def sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id):
+class LeaseLostError(Exception):
+    """Raised when another invocation has taken over this sync's lease."""
+
+class SyncLease:
+    """Per-shelter lease at shelters/{id}/sync_state/{sync_type}_lease, with a fencing token and
+    recent Pub/Sub message IDs, renewed by a background thread while the sync works.
+
+    Each Cloud Function deploys only its own directory, so this is a blocking-client copy of the
+    shelterluv function's SyncLease; keep the document layout of the two in step.
+    """
+
+    def __init__(self, client, shelter_ref, sync_type):
+        self._client = client
+        self._ref = shelter_ref.collection('sync_state').document(f'{sync_type}_lease')
+        self._stop_renewing = threading.Event()
+        self.holder = uuid.uuid4().hex
+        self.fencing_token = None
+        self.lost = False
+        self.released = False
+
+    def acquire(self, message_id=None):
+        """Returns 'acquired', 'duplicate' if the message was already processed, or 'held' if another
+        invocation holds an unexpired lease."""
+        @firestore.transactional
+        def acquire_in_transaction(transaction):
+            snapshot = self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone('UTC'))
+            if message_id and message_id in lease.get('recentMessageIds', []):
+                return 'duplicate'
+            if lease.get('holder') and lease.get('expiresAt') and lease['expiresAt'] > now:
+                return 'held'
+            self.fencing_token = lease.get('fencingToken', 0) + 1
+            transaction.set(self._ref, {
+                'holder': self.holder,
+                'fencingToken': self.fencing_token,
+                'messageId': message_id,
+                'acquiredAt': now,
+                'expiresAt': now + SYNC_LEASE_TTL
+            }, merge=True)
+            return 'acquired'
+
+        status = acquire_in_transaction(self._client.transaction())
+        if status == 'acquired':
+            threading.Thread(target=self._renew_periodically, daemon=True).start()
+        else:
+            self.released = True  # nothing to release
+        return status
+
+    def ensure_held(self):
+        """Renews the lease, raising LeaseLostError if another invocation has taken it over."""
+        if self.lost:
+            raise LeaseLostError("Sync lease was taken over by another invocation")
+
+        @firestore.transactional
+        def renew_in_transaction(transaction):
+            snapshot = self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get('holder') != self.holder or lease.get('fencingToken') != self.fencing_token:
+                return False
+            transaction.update(self._ref, {'expiresAt': datetime.now(timezone('UTC')) + SYNC_LEASE_TTL})
+            return True
+
+        if not renew_in_transaction(self._client.transaction()):
+            self.lost = True
+            raise LeaseLostError("Sync lease was taken over by another invocation")
+
+    def release(self, message_id=None):
+        """Gives up the lease, recording message_id as processed if given. Errors are only logged,
+        since an unreleased lease simply expires."""
+        self._stop_renewing.set()
+        self.released = True
+        if self.lost or self.fencing_token is None:
+            return
+
+        @firestore.transactional
+        def release_in_transaction(transaction):
+            snapshot = self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get('holder') != self.holder or lease.get('fencingToken') != self.fencing_token:
+                return
+            release_data = {'holder': None, 'expiresAt': datetime.now(timezone('UTC'))}
+            if message_id:
+                release_data['recentMessageIds'] = (lease.get('recentMessageIds', []) + [message_id])[-SYNC_LEASE_RECENT_MESSAGES:]
+                release_data['lastCompletedAt'] = firestore.SERVER_TIMESTAMP
+            transaction.update(self._ref, release_data)
+
+        try:
+            release_in_transaction(self._client.transaction())
+        except Exception as e:
+            print(f"[DEBUG] Error releasing sync lease: {e}")
+
+    def _renew_periodically(self):
+        while not self._stop_renewing.wait(SYNC_LEASE_TTL.total_seconds() / 3):
+            try:
+                self.ensure_held()
+            except LeaseLostError:
+                print("[DEBUG] Sync lease was taken over by another invocation; remaining writes will be stopped.")
+                return
+            except Exception as e:
+                print(f"[DEBUG] Error renewing sync lease: {e}")
+
+class SyncWriter:
+    """Queues sync writes on a Firestore BulkWriter, retrying transient errors per document.
+
+    close() returns the write counts and latencies, and raises if any write ultimately failed.
+    """
+
+    def __init__(self, client, lease=None):
+        self._lease = lease
+        self._bulk_writer = client.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=SYNC_WRITER_INITIAL_OPS_PER_SECOND,
+            max_ops_per_second=SYNC_WRITER_MAX_OPS_PER_SECOND,
+        ))
+        self._bulk_writer.on_write_result(self._on_write_result)
+        self._bulk_writer.on_write_error(self._on_write_error)
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._enqueued_at = {}
+        self._latencies = []
+        self._failed_paths = []
+        self.stats = {'sets': 0, 'updates': 0, 'succeeded': 0, 'retried': 0, 'failed': 0}
+
+    def set(self, doc_ref, data):
+        self._track(doc_ref, 'sets')
+        self._bulk_writer.set(doc_ref, data)
+
+    def update(self, doc_ref, data):
+        self._track(doc_ref, 'updates')
+        self._bulk_writer.update(doc_ref, data)
+
+    def close(self):
+        """Waits for every queued write and returns the write stats."""
+        self._bulk_writer.close()
+        latencies = sorted(self._latencies)
+        self.stats['elapsedMs'] = round((time.monotonic() - self._started_at) * 1000)
+        if latencies:
+            self.stats['p50LatencyMs'] = round(latencies[len(latencies) // 2] * 1000)
+            self.stats['p95LatencyMs'] = round(latencies[int(len(latencies) * 0.95)] * 1000)
+            self.stats['maxLatencyMs'] = round(latencies[-1] * 1000)
+        if self._failed_paths:
+            raise RuntimeError(f"{len(self._failed_paths)} Firestore writes failed, e.g. {self._failed_paths[:5]}")
+        return self.stats
+
+    def _track(self, doc_ref, kind):
+        if self._lease is not None and self._lease.lost:
+            raise LeaseLostError("Sync lease was taken over by another invocation; stopping writes")
+        with self._lock:
+            self.stats[kind] += 1
+            self._enqueued_at[doc_ref.path] = time.monotonic()
+
+    def _on_write_result(self, doc_ref, result, bulk_writer):
+        with self._lock:
+            self.stats['succeeded'] += 1
+            enqueued_at = self._enqueued_at.pop(doc_ref.path, None)
+            if enqueued_at is not None:
+                self._latencies.append(time.monotonic() - enqueued_at)
+
+    def _on_write_error(self, failure, bulk_writer):
+        with self._lock:
+            if failure.code in RETRYABLE_WRITE_CODES and failure.attempts < SYNC_WRITER_MAX_ATTEMPTS:
+                self.stats['retried'] += 1
+                return True
+            self.stats['failed'] += 1
+            self._failed_paths.append(failure.operation.reference.path)
+            print(f"Write to {failure.operation.reference.path} failed: {failure.message}")
+            return False
+
+def sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id, lease=None):
     """Sync DataFrame data to Firestore collections."""
     print("[DEBUG] Entering sync_df_to_firestore.")
     print("[DEBUG] Streaming existing documents in Cats collection to create a set of IDs.")
@@ -350,8 +580,8 @@ def sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id):
     existing_dogs = {doc.id for doc in dogs_ref.stream()}
     print(f"[DEBUG] existing_dogs: {existing_dogs}")
 
-    print("[DEBUG] Creating Firestore batch for updates.")
-    batch = db.batch()
+    print("[DEBUG] Creating SyncWriter for updates.")
+    writer = SyncWriter(db, lease)
 
     print("[DEBUG] Iterating through DataFrame rows...")
     for index, row in df.iterrows():
@@ -502,8 +732,8 @@ def sync_df_to_firestore(df, cats_ref, dogs_ref, shelter_id):
         else:
             data['medicalCategory'] = medicalCategory
 
-        print(f"[DEBUG] Final data to batch update: {data}")
-        batch.update(doc_ref, data)
-    print("[DEBUG] Committing Firestore batch updates now...")
-    batch.commit()
-    print("[DEBUG] Firestore batch commit complete.")
+        print(f"[DEBUG] Final data to queue for update: {data}")
+        writer.update(doc_ref, data)
+    print("[DEBUG] Waiting for queued Firestore writes to complete...")
+    write_stats = writer.close()
+    print(f"[DEBUG] Firestore writes complete: {write_stats}")
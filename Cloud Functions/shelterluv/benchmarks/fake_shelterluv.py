@@ -0,0 +1,177 @@
+"""Local stand-in for the ShelterLuv animals API, plus the bits of the Storage JSON API the sync touches.
+
+Serves a deterministic synthetic shelter that the benchmark runner can churn between syncs.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SPECIES = ['Cat', 'Dog', 'Rabbit']
+SPECIES_WEIGHTS = [0.45, 0.45, 0.10]
+BREEDS = {
+    'Cat': ['Domestic Shorthair', 'Domestic Longhair', 'Siamese', 'Tabby'],
+    'Dog': ['Labrador Retriever', 'Pit Bull Terrier', 'Beagle', 'German Shepherd', 'Chihuahua'],
+    'Rabbit': ['Lionhead', 'Rex', 'Dutch'],
+}
+NAMES = ['Luna', 'Milo', 'Bella', 'Oliver', 'Daisy', 'Max', 'Cleo', 'Buddy', 'Nala', 'Rocky', 'Pepper', 'Ziggy']
+
+class SyntheticShelter:
+    """An ordered census of fake ShelterLuv animals, generated from a seed so runs are reproducible."""
+
+    def __init__(self, size, seed=0):
+        self.rng = random.Random(seed)
+        self.next_id = 10000
+        self.clock = 1730000000  # advanced by every edit, like ShelterLuv's LastUpdatedUnixTime
+        self.animals = {}
+        for _ in range(size):
+            self.add_animal()
+
+    def add_animal(self):
+        animal_id = str(self.next_id)
+        self.next_id += 1
+        species = self.rng.choices(SPECIES, SPECIES_WEIGHTS)[0]
+        self.animals[animal_id] = {
+            'ID': animal_id,
+            'Type': species,
+            'Name': f"{self.rng.choice(NAMES)} ({animal_id})",
+            'Sex': self.rng.choice(['Male', 'Female']),
+            'Age': self.rng.randint(2, 180),
+            'Breed': self.rng.choice(BREEDS[species]),
+            'Description': ' '.join(self.rng.choice(NAMES) for _ in range(self.rng.randint(20, 80))),
+            'CurrentLocation': {
+                'Tier1': 'Main Shelter',
+                'Tier2': f"Building {self.rng.randint(1, 4)}",
+                'Tier3': f"Kennel {self.rng.randint(1, 60)}",
+            },
+            'LastIntakeUnixTime': str(1700000000 + self.rng.randint(0, 30000000)),
+            'Photos': self.photo_urls(animal_id, self.rng.randint(1, 3)),
+            'LastUpdatedUnixTime': self.touch(),
+        }
+        return animal_id
+
+    def touch(self):
+        self.clock += 1
+        return str(self.clock)
+
+    def photo_urls(self, animal_id, count, version=0):
+        return [f"https://photos.shelterluv.invalid/{animal_id}/{version}-{n}.jpg" for n in range(count)]
+
+    def apply_churn(self, added=0.0, changed=0.0, removed=0.0):
+        """Adds, edits and removes fractions of the current census. Returns the affected IDs."""
+        current_ids = list(self.animals)
+        removed_ids = self.rng.sample(current_ids, int(len(current_ids) * removed))
+        for animal_id in removed_ids:
+            del self.animals[animal_id]
+
+        changed_ids = self.rng.sample(list(self.animals), int(len(self.animals) * changed))
+        for animal_id in changed_ids:
+            animal = self.animals[animal_id]
+            edit = self.rng.choice(['location', 'name', 'photos', 'description'])
+            if edit == 'location':
+                animal['CurrentLocation'] = dict(animal['CurrentLocation'], Tier3=f"Kennel {self.rng.randint(61, 120)}")
+            elif edit == 'name':
+                animal['Name'] = f"{self.rng.choice(NAMES)} II ({animal_id})"
+            elif edit == 'photos':
+                animal['Photos'] = self.photo_urls(animal_id, self.rng.randint(1, 3), version=self.rng.randint(1, 9))
+            else:
+                animal['Description'] += ' Update: doing great in foster.'
+            animal['LastUpdatedUnixTime'] = self.touch()
+
+        added_ids = [self.add_animal() for _ in range(int(len(current_ids) * added))]
+        return {'added': added_ids, 'changed': changed_ids, 'removed': removed_ids}
+
+    def page(self, offset, limit):
+        animals = list(self.animals.values())
+        return {
+            'success': 1,
+            'animals': animals[offset:offset + limit],
+            'has_more': offset + limit < len(animals),
+            'total_count': len(animals),
+        }
+
+class FakeShelterLuvServer:
+    """Threaded HTTP server answering /api/v1/animals from a SyntheticShelter and counting requests.
+
+    With `etags` on, responses carry a content ETag and matching If-None-Match requests get a 304.
+    `latency` adds a fixed delay per request to approximate the real API's response times.
+    """
+
+    def __init__(self, shelter, etags=False, latency=0.0):
+        self.shelter = shelter
+        self.etags = etags
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset_counters(self):
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, body, headers=None):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlparse(self.path)
+                if url.path.startswith('/storage/v1/'):
+                    # Listing blobs for image cleanup; the benchmark shelter has no stored images
+                    server.count('storageCalls')
+                    self.send_json(json.dumps({'kind': 'storage#objects'}).encode('utf-8'))
+                    return
+
+                server.count('shelterluvCalls')
+                query = parse_qs(url.query)
+                offset = int(query.get('offset', ['0'])[0])
+                limit = int(query.get('limit', ['100'])[0])
+                body = json.dumps(server.shelter.page(offset, limit)).encode('utf-8')
+
+                headers = {}
+                if server.etags:
+                    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        server.count('shelterluvNotModified')
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.end_headers()
+                        return
+                    headers['ETag'] = etag
+                server.count('shelterluvBytes', len(body))
+                self.send_json(body, headers)
+
+        return Handler
@@ -0,0 +1,188 @@
+"""Benchmarks the ShelterLuv sync against the Firestore emulator and a local fake ShelterLuv API.
+
+Each scenario clears the emulator, then runs three syncs for a synthetic shelter, each in a fresh
+subprocess so peak RSS and cold-instance behaviour are measured per sync:
+
+    cold    every animal is new
+    churn   after adding, changing and removing a fraction of animals and deleting some photos
+    steady  nothing changed since the churn sync
+
+Start the emulator first (`gcloud emulators firestore start --host-port=localhost:8080`), then:
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/run_benchmarks.py --sizes 100,1000
+
+Results are written as JSON (by default to benchmarks/results/<commit>.json). Pass --baseline with
+an earlier results file to print the change in wall time, reads, writes and HTTP calls.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import requests
+from google.cloud import firestore
+
+from fake_shelterluv import FakeShelterLuvServer, SyntheticShelter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [100, 1000, 5000, 20000]
+DEFAULT_PROJECT = 'shelterpartner-benchmarks'
+API_KEY = 'benchmark-api-key'
+PHASES = ['cold', 'churn', 'steady']
+COMPARED_METRICS = ['wallTimeSeconds', 'firestoreReads', 'firestoreWrites', 'shelterluvCalls', 'peakRssMb']
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def clear_emulator(emulator_host, project):
+    response = requests.delete(
+        f"http://{emulator_host}/emulator/v1/projects/{project}/databases/(default)/documents", timeout=30
+    )
+    response.raise_for_status()
+
+def collection_for(animal):
+    species = animal['Type'].lower()
+    return {'cat': 'cats', 'dog': 'dogs'}.get(species, 'other')
+
+def delete_photos(db, shelter_id, shelter, fraction, rng):
+    """Records deleted_photos docs the way the app does, for a fraction of the current animals."""
+    animals = [animal for animal in shelter.animals.values() if animal['Photos']]
+    deleted = rng.sample(animals, int(len(animals) * fraction))
+    batch = db.batch()
+    for count, animal in enumerate(deleted, start=1):
+        animal_doc_ref = db.collection('shelters').document(shelter_id) \
+            .collection(collection_for(animal)).document(animal['ID'])
+        batch.set(animal_doc_ref.collection('deleted_photos').document(), {
+            'url': animal['Photos'][0],
+            'deletedAt': firestore.SERVER_TIMESTAMP,
+            'source': 'shelterluv'
+        })
+        if count % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    return len(deleted)
+
+def run_sync(shelter_id, server, env):
+    """Runs one sync in a subprocess and merges its metrics with the fake server's request counts."""
+    server.reset_counters()
+    completed = subprocess.run(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, 'sync_once.py'),
+         '--shelter-id', shelter_id, '--api-key', API_KEY,
+         '--shelterluv-url', f"{server.url}/api/v1/animals"],
+        env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Sync for {shelter_id} failed:\n{completed.stderr or completed.stdout}")
+    metrics = json.loads(completed.stdout.strip().splitlines()[-1])
+    counters = server.reset_counters()
+    metrics['shelterluvCalls'] = counters.get('shelterluvCalls', 0)
+    metrics['shelterluvNotModified'] = counters.get('shelterluvNotModified', 0)
+    metrics['shelterluvBytes'] = counters.get('shelterluvBytes', 0)
+    metrics['storageCalls'] = counters.get('storageCalls', 0)
+    return metrics
+
+def run_scenario(size, args, env, db):
+    shelter_id = f"benchmark-{size}"
+    shelter = SyntheticShelter(size, seed=args.seed)
+    server = FakeShelterLuvServer(shelter, etags=args.etags, latency=args.latency_ms / 1000).start()
+    # The synthetic photo URLs don't resolve, so photo mirroring is left out of the measurements
+    env = dict(env, STORAGE_EMULATOR_HOST=server.url, SHELTERLUV_MIRROR_PHOTOS='false')
+    try:
+        clear_emulator(env['FIRESTORE_EMULATOR_HOST'], env['GOOGLE_CLOUD_PROJECT'])
+        db.collection('shelters').document(shelter_id).set({
+            'shelterSettings': {'apiKey': API_KEY, 'onlyIncludePrimaryPhotoFromShelterLuv': args.primary_photo_only}
+        })
+
+        results = {'cold': run_sync(shelter_id, server, env)}
+
+        churned = shelter.apply_churn(added=args.added, changed=args.changed, removed=args.removed)
+        deleted_photos = delete_photos(db, shelter_id, shelter, args.deleted_photos, shelter.rng)
+        results['churn'] = run_sync(shelter_id, server, env)
+        results['churn']['churn'] = {
+            'added': len(churned['added']),
+            'changed': len(churned['changed']),
+            'removed': len(churned['removed']),
+            'deletedPhotos': deleted_photos,
+        }
+
+        results['steady'] = run_sync(shelter_id, server, env)
+        return results
+    finally:
+        server.stop()
+
+def print_summary(results, baseline=None):
+    header = f"{'scenario':>10} {'phase':>7} " + ' '.join(f"{metric:>16}" for metric in COMPARED_METRICS)
+    print(header)
+    for size, phases in results['scenarios'].items():
+        for phase in PHASES:
+            metrics = phases[phase]
+            cells = []
+            for metric in COMPARED_METRICS:
+                cell = f"{metrics[metric]}"
+                previous = ((baseline or {}).get('scenarios', {}).get(size, {}).get(phase) or {}).get(metric)
+                if previous:
+                    cell += f" ({(metrics[metric] - previous) / previous:+.0%})"
+                cells.append(f"{cell:>16}")
+            print(f"{size:>10} {phase:>7} " + ' '.join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma-separated shelter sizes to benchmark')
+    parser.add_argument('--added', type=float, default=0.02, help='fraction of animals added by churn')
+    parser.add_argument('--changed', type=float, default=0.05, help='fraction of animals edited by churn')
+    parser.add_argument('--removed', type=float, default=0.02, help='fraction of animals removed by churn')
+    parser.add_argument('--deleted-photos', type=float, default=0.01,
+                        help='fraction of animals with a photo deleted in the app before the churn sync')
+    parser.add_argument('--all-photos', dest='primary_photo_only', action='store_false',
+                        help='sync every photo instead of only the primary one')
+    parser.add_argument('--etags', action='store_true', help='have the fake API send ETags and answer 304s')
+    parser.add_argument('--latency-ms', type=float, default=0, help='added latency per fake API request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    emulator_host = os.environ.get('FIRESTORE_EMULATOR_HOST')
+    if not emulator_host:
+        sys.exit('FIRESTORE_EMULATOR_HOST must point at a running Firestore emulator')
+    env = dict(os.environ)
+    env.setdefault('GOOGLE_CLOUD_PROJECT', DEFAULT_PROJECT)
+    os.environ['GOOGLE_CLOUD_PROJECT'] = env['GOOGLE_CLOUD_PROJECT']
+    db = firestore.Client(project=env['GOOGLE_CLOUD_PROJECT'])
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'scenarios': {},
+    }
+    for size in (int(size) for size in args.sizes.split(',')):
+        print(f"Benchmarking {size} animals...", file=sys.stderr)
+        results['scenarios'][str(size)] = run_scenario(size, args, env, db)
+
+    output = args.output or os.path.join(BENCHMARKS_DIR, 'results', f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}", file=sys.stderr)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Runs a single ShelterLuv sync in its own process and prints its metrics as one JSON line.
+
+Invoked by run_benchmarks.py with FIRESTORE_EMULATOR_HOST and STORAGE_EMULATOR_HOST already set.
+Firestore reads and writes are counted at the GAPIC layer, so they cover every code path in main.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.cloud.firestore_v1.services.firestore.async_client import FirestoreAsyncClient
+
+import main
+
+firestore_counters = {'reads': 0, 'writes': 0, 'rpcs': 0}
+
+class CountingStream:
+    """Wraps a server-streaming response, counting responses that carry a document."""
+
+    def __init__(self, stream, field):
+        self.stream = stream
+        self.field = field
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        response = await self.stream.__anext__()
+        if self.field in response:
+            firestore_counters['reads'] += 1
+        return response
+
+def count_streamed_reads(method, field):
+    def wrapper(self, *args, **kwargs):
+        firestore_counters['rpcs'] += 1
+        awaitable = method(self, *args, **kwargs)
+
+        async def counted():
+            return CountingStream(await awaitable, field)
+        return counted()
+    return wrapper
+
+def count_single_read(method):
+    async def wrapper(self, *args, **kwargs):
+        firestore_counters['rpcs'] += 1
+        firestore_counters['reads'] += 1
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+def count_writes(method):
+    async def wrapper(self, *args, **kwargs):
+        firestore_counters['rpcs'] += 1
+        request = kwargs.get('request', args[0] if args else None)
+        writes = request.get('writes', []) if isinstance(request, dict) else getattr(request, 'writes', [])
+        firestore_counters['writes'] += len(writes)
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+def instrument_firestore():
+    FirestoreAsyncClient.get_document = count_single_read(FirestoreAsyncClient.get_document)
+    FirestoreAsyncClient.batch_get_documents = count_streamed_reads(FirestoreAsyncClient.batch_get_documents, 'found')
+    FirestoreAsyncClient.run_query = count_streamed_reads(FirestoreAsyncClient.run_query, 'document')
+    FirestoreAsyncClient.commit = count_writes(FirestoreAsyncClient.commit)
+    FirestoreAsyncClient.batch_write = count_writes(FirestoreAsyncClient.batch_write)
+
+def run(shelter_id, api_key, shelterluv_url):
+    instrument_firestore()
+    main.SHELTERLUV_ANIMALS_URL = shelterluv_url
+
+    start = time.perf_counter()
+    response = asyncio.run(main.sync_shelter(api_key, shelter_id))
+    wall_time = time.perf_counter() - start
+
+    return {
+        'status': response[1] if isinstance(response, tuple) else None,
+        'wallTimeSeconds': round(wall_time, 3),
+        'firestoreReads': firestore_counters['reads'],
+        'firestoreWrites': firestore_counters['writes'],
+        'firestoreRpcs': firestore_counters['rpcs'],
+        # ru_maxrss is reported in kilobytes on Linux
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shelter-id', required=True)
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--shelterluv-url', required=True)
+    args = parser.parse_args()
+    print(json.dumps(run(args.shelter_id, args.api_key, args.shelterluv_url)))
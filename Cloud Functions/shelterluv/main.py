@@ -1,16 +1,102 @@
+import asyncio
 import functions_framework
 import requests
+from google.api_core import exceptions
 from google.cloud import firestore
 from google.cloud import storage
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import os
 import uuid
 import re
 import base64
+import hashlib
+import io
 import json  # Import json module for parsing
+import random
+import threading
+import time
+import zlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from urllib.parse import quote
+from PIL import Image, ImageOps
 
-# Initialize Firestore and Storage clients outside the function for efficiency
-db = firestore.Client()
+try:
+    from opentelemetry import propagate, trace
+    tracer = trace.get_tracer(__name__)
+except ImportError:  # Tracing is optional; sync metrics are still collected and stored without it
+    propagate = tracer = None
+
+# Initialize the Storage client outside the function for efficiency. The Firestore AsyncClient is
+# bound to an event loop, so each sync creates its own in sync_shelter.
 storage_client = storage.Client()
+STORAGE_BUCKET = 'production-10b3e.firebasestorage.app'
+
+# Maximum number of Firestore reads/commits (and Storage cleanups) in flight per sync
+FIRESTORE_MAX_CONCURRENT_REQUESTS = int(os.environ.get('FIRESTORE_MAX_CONCURRENT_REQUESTS', 8))
+# Raw ShelterLuv pages buffered between the page loader and the diff loop
+PAGE_QUEUE_SIZE = 2
+
+# Number of animal documents requested per get_all() call when prefetching
+PREFETCH_CHUNK_SIZE = 100
+
+# Parsed fields covered by an animal's fingerprint (photos are added as their URLs). Bump
+# MANIFEST_VERSION whenever this or parse_animal's output changes so every animal is re-diffed.
+FINGERPRINT_FIELDS = ['species', 'name', 'location', 'fullLocation', 'description', 'sex', 'monthsOld', 'breed']
+MANIFEST_VERSION = 1
+
+# Between full reconciliations, animals whose LastUpdatedUnixTime is older than the previous sync's
+# high-water mark are carried forward without being parsed. A full sync re-diffs every animal
+# document, which also repairs app-side edits and any drift between the manifest and the docs.
+SHELTERLUV_FULL_SYNC_INTERVAL = timedelta(hours=float(os.environ.get('SHELTERLUV_FULL_SYNC_INTERVAL_HOURS', 24)))
+
+# Sync lease: how long a lease lasts without renewal, and how many processed message IDs are kept
+SYNC_LEASE_TTL = timedelta(seconds=int(os.environ.get('SYNC_LEASE_TTL_SECONDS', 120)))
+SYNC_LEASE_RECENT_MESSAGES = 20
+
+# Batched write settings: operations per commit, commits in flight, and per-batch retries
+WRITE_BATCH_SIZE = 250
+SYNC_WRITER_MAX_IN_FLIGHT = int(os.environ.get('SYNC_WRITER_MAX_IN_FLIGHT', 8))
+SYNC_WRITER_MAX_ATTEMPTS = 10
+SYNC_WRITER_BASE_BACKOFF = 0.25  # seconds
+SYNC_WRITER_MAX_BACKOFF = 10  # seconds
+RETRYABLE_WRITE_ERRORS = (
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+)
+
+# ShelterLuv API paging, retry and timeout settings
+SHELTERLUV_ANIMALS_URL = "https://www.shelterluv.com/api/v1/animals"
+SHELTERLUV_PAGE_SIZE = 100
+SHELTERLUV_MAX_CONCURRENT_PAGES = int(os.environ.get('SHELTERLUV_MAX_CONCURRENT_PAGES', 4))
+SHELTERLUV_REQUEST_TIMEOUT = 30  # seconds
+SHELTERLUV_MAX_RETRIES = 5
+SHELTERLUV_BASE_BACKOFF = 0.5  # seconds
+SHELTERLUV_MAX_BACKOFF = 30  # seconds
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Where page validators persist between instances: 'firestore', or 'none' to keep them in memory only
+SHELTERLUV_PAGE_CACHE_STORE = os.environ.get('SHELTERLUV_PAGE_CACHE_STORE', 'firestore')
+
+# Photo mirroring: new ShelterLuv photos are copied into storage under {shelterId}/{animalId}/ as
+# resized JPEG variants (named like the app's own resized uploads), and the animal's photo entry
+# points at PHOTO_DISPLAY_SIZE. Variants are keyed by content hash, so re-mirroring is a no-op.
+SHELTERLUV_MIRROR_PHOTOS = os.environ.get('SHELTERLUV_MIRROR_PHOTOS', 'true').lower() == 'true'
+PHOTO_VARIANT_SIZES = [250, 750]  # bounding box edge, in pixels
+PHOTO_DISPLAY_SIZE = '750x750'
+PHOTO_MIRROR_MAX_CONCURRENT = int(os.environ.get('PHOTO_MIRROR_MAX_CONCURRENT', 4))
+PHOTO_JPEG_QUALITY = 85
+MIRRORED_PHOTO_PATTERN = re.compile(r'shelterluv_([0-9a-f]{32})_\d+x\d+')
+
+# Shared session so warm instances reuse keep-alive connections to ShelterLuv
+shelterluv_session = requests.Session()
+shelterluv_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=SHELTERLUV_MAX_CONCURRENT_PAGES))
 
 @functions_framework.http
 def main(request):
@@ -43,34 +129,128 @@ def main(request):
 
     if not api_key or not shelterId:
         return 'Invalid request: apiKey and shelterId are required', 400
+    # Optional flag to force a full reconciliation instead of waiting for the next scheduled one
+    full_sync = bool(data_json.get('fullSync'))
+    # Pub/Sub redelivers with the same message ID, which lets the lease skip work that already finished
+    message_id = message.get('messageId') or message.get('message_id')
+
+    # Continue the caller's trace when OpenTelemetry is installed and a traceparent header was sent
+    trace_context = propagate.extract(request.headers) if propagate is not None else None
+    return asyncio.run(sync_shelter(api_key, shelterId, trace_context, full_sync, message_id))
+
+class SyncMetrics:
+    """Per-phase timings and counters for one sync run, stored on the shelter doc as lastSyncMetrics.
+
+    Phase times are summed over every span with that name, so phases that overlap (paging alongside
+    diffing, parallel page fetches and commits) can add up to more than the run's total. When
+    OpenTelemetry is installed, each span is also recorded as a trace span.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # page fetches report from worker threads
+        self._started_at = time.monotonic()
+        self.phase_seconds = {}
+        self.counters = {}
+
+    @contextmanager
+    def span(self, phase, context=None):
+        otel_span = tracer.start_as_current_span(f"shelterluv.{phase}", context=context) if tracer else nullcontext()
+        started_at = time.monotonic()
+        try:
+            with otel_span:
+                yield
+        finally:
+            elapsed = time.monotonic() - started_at
+            with self._lock:
+                self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + elapsed
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        with self._lock:
+            return {
+                'totalMs': round((time.monotonic() - self._started_at) * 1000),
+                'phasesMs': {phase: round(seconds * 1000) for phase, seconds in self.phase_seconds.items()},
+                **self.counters
+            }
+
+async def sync_shelter(api_key, shelterId, trace_context=None, full_sync=False, message_id=None):
+    """Runs a ShelterLuv sync for one shelter, overlapping independent Firestore reads and writes.
+
+    Only one sync per shelter runs at a time; an invocation that finds the lease held, or whose
+    message was already processed, returns straight away so Pub/Sub doesn't redeliver it.
+    """
+    async_db = firestore.AsyncClient()
+    shelter_doc_ref = async_db.collection('shelters').document(shelterId)
+    lease = SyncLease(async_db, shelter_doc_ref, 'shelterluv_api')
+
+    lease_status = await lease.acquire(message_id)
+    if lease_status == 'duplicate':
+        print(f"Message {message_id} for shelter {shelterId} was already processed, skipping")
+        return f'Message {message_id} already processed', 200
+    if lease_status == 'held':
+        print(f"A ShelterLuv sync for shelter {shelterId} is already running, skipping")
+        return f'Sync already running for shelter {shelterId}', 200
+
+    metrics = SyncMetrics()
+    try:
+        with metrics.span('sync', context=trace_context):
+            result = await run_sync(async_db, shelter_doc_ref, api_key, shelterId, metrics, lease, full_sync)
+    except LeaseLostError as e:
+        # The invocation that took over the lease finishes the sync, so there's nothing to retry
+        print(f"Stopped ShelterLuv sync for shelter {shelterId}: {e}")
+        return f'Sync for shelter {shelterId} was taken over by another invocation', 200
+    except Exception:
+        # Release without recording the message, so a redelivery can retry the sync
+        await lease.release()
+        raise
+    await lease.release(message_id)
+    return result
+
+async def run_sync(async_db, shelter_doc_ref, api_key, shelterId, metrics, lease, full_sync=False):
+    semaphore = asyncio.Semaphore(FIRESTORE_MAX_CONCURRENT_REQUESTS)
 
     # Initialize Firestore document references using the shelterId
-    shelter_doc_ref = db.collection('shelters').document(shelterId)
     cats_ref = shelter_doc_ref.collection('cats')
     dogs_ref = shelter_doc_ref.collection('dogs')
     other_ref = shelter_doc_ref.collection('other')
 
-    # Fetch shelter settings to determine photo filtering behavior
-    try:
-        shelter_doc = shelter_doc_ref.get()
-        shelter_settings = shelter_doc.to_dict().get('shelterSettings', {}) if shelter_doc.exists else {}
-        only_include_primary_photo = shelter_settings.get('onlyIncludePrimaryPhotoFromShelterLuv', True)
-    except Exception as e:
-        print(f"Error fetching shelter settings: {e}")
-        only_include_primary_photo = True  # Default to true if error
+    raw_pages = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+    page_loader = None
 
-    # Fetch and process animals
+    # Fetch and process animals one page at a time so only a few pages are held in memory
     try:
-        animals, original_animals = fetch_all_animals(api_key)
-        processed_animals = [parse_animal(animal, only_include_primary_photo) for animal in animals]
-        update_firestore_optimized(processed_animals, shelter_doc_ref, cats_ref, dogs_ref, other_ref, shelterId)
+        # The photo setting is part of the page cache key, so it's read before paging starts
+        with metrics.span('setup'):
+            only_include_primary_photo, sync_token, last_full_sync = await fetch_shelter_settings(shelter_doc_ref, semaphore)
+            metrics.count('firestoreReads')
+            if last_full_sync is None or datetime.now(timezone.utc) - last_full_sync >= SHELTERLUV_FULL_SYNC_INTERVAL:
+                full_sync = True
+            cache_key = page_cache_key(api_key, only_include_primary_photo)
+            if full_sync:
+                # A full sync re-reads every page so nothing can be carried forward from the last run
+                page_cache = PageCache(cache_key, {})
+                metrics.count('fullSync')
+            else:
+                page_cache = await load_page_cache(shelter_doc_ref, cache_key, sync_token, semaphore, metrics)
+        page_loader = asyncio.create_task(load_animal_pages(api_key, raw_pages, page_cache, metrics))
+
+        manifest_ref = shelter_doc_ref.collection('sync_state').document('shelterluv_manifest')
+        await update_firestore_optimized(
+            raw_pages, api_key, only_include_primary_photo, manifest_ref,
+            async_db, semaphore, shelter_doc_ref, cats_ref, dogs_ref, other_ref, shelterId, metrics, lease, full_sync
+        )
+        with metrics.span('finalize'):
+            await commit_page_cache(shelter_doc_ref, page_cache, semaphore, metrics)
     except requests.exceptions.HTTPError as e:
         # Check if the error indicates a revoked/invalid API key
         if e.response.status_code in [401, 403]:
             print(f"API key revoked or invalid for shelter {shelterId}. Clearing API key.")
             try:
                 # Clear the API key by setting it to an empty string
-                shelter_doc_ref.update({'shelterSettings.apiKey': ''})
+                await shelter_doc_ref.update({'shelterSettings.apiKey': ''})
                 print(f"Successfully cleared API key for shelter {shelterId}")
                 return f'API key revoked for shelter {shelterId}. Key has been cleared.', 200
             except Exception as clear_error:
@@ -84,191 +264,1021 @@ def main(request):
         # Handle other types of exceptions
         print(f"Unexpected error fetching animals for shelter {shelterId}: {e}")
         raise
+    finally:
+        if page_loader is not None:
+            page_loader.cancel()
 
     # Update the shelter document with the last sync times
+    await lease.ensure_held()
     try:
         update_data = {
             "lastApiSync": firestore.SERVER_TIMESTAMP,
             "lastApiSyncTime": firestore.SERVER_TIMESTAMP, 
             "lastCatApiSync": firestore.SERVER_TIMESTAMP,
-            "lastDogApiSync": firestore.SERVER_TIMESTAMP
+            "lastDogApiSync": firestore.SERVER_TIMESTAMP,
+            "shelterluvSyncToken": page_cache.token
         }
-        shelter_doc_ref.update(update_data)
+        if full_sync:
+            update_data["shelterluvLastFullSync"] = firestore.SERVER_TIMESTAMP
+        metrics.count('firestoreWrites')
+        update_data["lastSyncMetrics"] = metrics.summary()
+        print(f"Sync metrics for shelter {shelterId}: {update_data['lastSyncMetrics']}")
+        await shelter_doc_ref.update(update_data)
     except Exception as e:
         # Create the document if it doesn't exist
-        shelter_doc_ref.set(update_data)
+        await shelter_doc_ref.set(update_data)
 
     return 'Finished updating shelter', 200
 
-def update_firestore_optimized(animals, shelter_doc_ref, cats_ref, dogs_ref, other_ref, shelterId):
-    batch = db.batch()
-    operations_count = 0
-    max_batch_size = 499  # Firestore's limit per batch
+async def load_animal_pages(api_key, raw_pages, page_cache=None, metrics=None):
+    """Feeds raw ShelterLuv pages into the queue, followed by None, or by the exception that stopped paging."""
+    pages = iter_animal_pages(api_key, page_cache, metrics)
+    try:
+        while True:
+            # Paging is blocking HTTP, so advance the generator on a worker thread
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            await raw_pages.put(page)
+    except Exception as e:
+        await raw_pages.put(e)
+        return
+    await raw_pages.put(None)
+
+class LeaseLostError(Exception):
+    """Raised when another invocation has taken over this sync's lease."""
+
+class SyncLease:
+    """Per-shelter lease that keeps overlapping syncs of the same type from running at once.
+
+    The lease lives at shelters/{id}/sync_state/{sync_type}_lease. Every acquisition bumps a fencing
+    token; the holder renews the lease while it works and checks the token before committing sync
+    state, so an invocation that stalls past the TTL and loses the lease stops instead of overwriting
+    the newer sync's work. Pub/Sub message IDs are recorded on a successful release so a redelivered
+    message is acknowledged without running again.
+    """
+
+    def __init__(self, client, shelter_doc_ref, sync_type):
+        self._client = client
+        self._ref = shelter_doc_ref.collection('sync_state').document(f'{sync_type}_lease')
+        self._heartbeat = None
+        self.holder = uuid.uuid4().hex
+        self.fencing_token = None
+        self.lost = False
+
+    async def acquire(self, message_id=None):
+        """Returns 'acquired', 'duplicate' if the message was already processed, or 'held' if another
+        invocation holds an unexpired lease."""
+        @firestore.async_transactional
+        async def acquire_in_transaction(transaction):
+            snapshot = await self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            if message_id and message_id in lease.get('recentMessageIds', []):
+                return 'duplicate'
+            if lease.get('holder') and lease.get('expiresAt') and lease['expiresAt'] > now:
+                return 'held'
+            self.fencing_token = lease.get('fencingToken', 0) + 1
+            transaction.set(self._ref, {
+                'holder': self.holder,
+                'fencingToken': self.fencing_token,
+                'messageId': message_id,
+                'acquiredAt': now,
+                'expiresAt': now + SYNC_LEASE_TTL
+            }, merge=True)
+            return 'acquired'
+
+        status = await acquire_in_transaction(self._client.transaction())
+        if status == 'acquired':
+            self._heartbeat = asyncio.create_task(self._renew_periodically())
+        return status
+
+    async def ensure_held(self):
+        """Renews the lease, raising LeaseLostError if another invocation has taken it over."""
+        if self.lost:
+            raise LeaseLostError("Sync lease was taken over by another invocation")
+
+        @firestore.async_transactional
+        async def renew_in_transaction(transaction):
+            snapshot = await self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get('holder') != self.holder or lease.get('fencingToken') != self.fencing_token:
+                return False
+            transaction.update(self._ref, {'expiresAt': datetime.now(timezone.utc) + SYNC_LEASE_TTL})
+            return True
+
+        if not await renew_in_transaction(self._client.transaction()):
+            self.lost = True
+            raise LeaseLostError("Sync lease was taken over by another invocation")
+
+    async def release(self, message_id=None):
+        """Gives up the lease, recording message_id as processed if given. Errors are only logged,
+        since an unreleased lease simply expires."""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        if self.lost or self.fencing_token is None:
+            return
+
+        @firestore.async_transactional
+        async def release_in_transaction(transaction):
+            snapshot = await self._ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get('holder') != self.holder or lease.get('fencingToken') != self.fencing_token:
+                return
+            release_data = {'holder': None, 'expiresAt': datetime.now(timezone.utc)}
+            if message_id:
+                release_data['recentMessageIds'] = (lease.get('recentMessageIds', []) + [message_id])[-SYNC_LEASE_RECENT_MESSAGES:]
+                release_data['lastCompletedAt'] = firestore.SERVER_TIMESTAMP
+            transaction.update(self._ref, release_data)
+
+        try:
+            await release_in_transaction(self._client.transaction())
+        except Exception as e:
+            print(f"Error releasing sync lease: {e}")
+
+    async def _renew_periodically(self):
+        while True:
+            await asyncio.sleep(SYNC_LEASE_TTL.total_seconds() / 3)
+            try:
+                await self.ensure_held()
+            except LeaseLostError:
+                print("Sync lease was taken over by another invocation; remaining writes will be stopped")
+                return
+            except Exception as e:
+                print(f"Error renewing sync lease: {e}")
+
+async def fetch_shelter_settings(shelter_doc_ref, semaphore):
+    """Reads the shelter's photo filtering setting, defaulting to primary photo only, along with the
+    token and full-sync time recorded by its previous ShelterLuv syncs."""
+    try:
+        async with semaphore:
+            shelter_doc = await shelter_doc_ref.get()
+        shelter_data = shelter_doc.to_dict() if shelter_doc.exists else {}
+        shelter_settings = shelter_data.get('shelterSettings', {})
+        return (shelter_settings.get('onlyIncludePrimaryPhotoFromShelterLuv', True),
+                shelter_data.get('shelterluvSyncToken'),
+                shelter_data.get('shelterluvLastFullSync'))
+    except Exception as e:
+        print(f"Error fetching shelter settings: {e}")
+        return True, None, None  # Default to true if error
+
+class PageCache:
+    """Validators for each ShelterLuv page from the last completed sync, plus the ones seen this run.
+
+    Entries for this run are only staged; commit_page_cache promotes them once the sync has succeeded,
+    so a failed sync never leaves pages marked as unchanged that were not actually written.
+    """
+
+    def __init__(self, key, entries):
+        self.key = key
+        self.entries = entries
+        self.staged = {}
+        self.token = uuid.uuid4().hex
+
+    def get(self, offset):
+        return self.entries.get(str(offset))
+
+    def stage(self, offset, entry):
+        self.staged[str(offset)] = entry
+
+class FirestorePageCacheStore:
+    """Keeps page validators in the shelter's sync state so cold instances can send conditional requests too.
+
+    Any object with the same async load/save methods can be assigned to page_cache_store instead.
+    """
+
+    def document(self, shelter_doc_ref):
+        return shelter_doc_ref.collection('sync_state').document('shelterluv_page_cache')
+
+    async def load(self, shelter_doc_ref):
+        cache_doc = await self.document(shelter_doc_ref).get()
+        return cache_doc.to_dict() if cache_doc.exists else None
+
+    async def save(self, shelter_doc_ref, cache):
+        await self.document(shelter_doc_ref).set(cache)
+
+# Page caches from syncs completed on this instance, by shelter ID, and the persistent store behind them
+page_cache_memory = {}
+page_cache_store = FirestorePageCacheStore() if SHELTERLUV_PAGE_CACHE_STORE == 'firestore' else None
+
+def page_cache_key(api_key, only_include_primary_photo):
+    """Pages only count as unchanged for the same API key, photo setting and fingerprint version."""
+    api_key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return f"{api_key_hash}:{int(bool(only_include_primary_photo))}:{MANIFEST_VERSION}"
+
+async def load_page_cache(shelter_doc_ref, cache_key, sync_token, semaphore, metrics=None):
+    """Loads the page cache from memory or the persistent store.
+
+    A cache is only trusted if it was written by the sync that last completed for this shelter,
+    which rules out stale copies on instances that missed a later sync.
+    """
+    cache = page_cache_memory.get(shelter_doc_ref.id)
+    if (cache is None or cache.get('token') != sync_token) and page_cache_store is not None:
+        try:
+            async with semaphore:
+                cache = await page_cache_store.load(shelter_doc_ref)
+            if metrics:
+                metrics.count('firestoreReads')
+        except Exception as e:
+            print(f"Error loading page cache: {e}")
+            cache = None
+
+    if cache and sync_token and cache.get('token') == sync_token and cache.get('key') == cache_key:
+        return PageCache(cache_key, cache.get('pages') or {})
+    return PageCache(cache_key, {})
+
+async def commit_page_cache(shelter_doc_ref, page_cache, semaphore, metrics=None):
+    """Promotes this run's staged page validators once the sync has completed."""
+    cache = {'key': page_cache.key, 'token': page_cache.token, 'pages': page_cache.staged}
+    page_cache_memory[shelter_doc_ref.id] = cache
+    if page_cache_store is None:
+        return
+    try:
+        async with semaphore:
+            await page_cache_store.save(shelter_doc_ref, cache)
+        if metrics:
+            metrics.count('firestoreWrites')
+    except Exception as e:
+        # The sync token won't match this cache, so the next cold start simply re-fetches every page
+        print(f"Error saving page cache: {e}")
+
+class AsyncBatchWriter:
+    """Groups sync writes into batches and commits several batches concurrently.
+
+    A batch that hits contention or a transient error is retried with backoff, then split into
+    single-document commits so one bad write can't hold back the rest. Updates queued with
+    ignore_missing succeed if their document no longer exists. Write counts and commit latencies
+    are collected so callers can log them; close() raises if any write ultimately failed.
+    """
+
+    def __init__(self, client, semaphore, lease=None):
+        self._client = client
+        self._semaphore = semaphore
+        self._lease = lease
+        self._operations = []
+        self._pending = set()
+        self._error = None  # first exception that escaped a batch commit
+        self._started_at = time.monotonic()
+        self._latencies = []
+        self._failed_paths = []
+        self.stats = {'sets': 0, 'updates': 0, 'batches': 0, 'succeeded': 0, 'retried': 0, 'missing': 0, 'failed': 0}
+
+    async def set(self, doc_ref, data):
+        self.stats['sets'] += 1
+        await self._add(('set', doc_ref, data, False))
+
+    async def update(self, doc_ref, data, ignore_missing=False):
+        self.stats['updates'] += 1
+        await self._add(('update', doc_ref, data, ignore_missing))
+
+    async def close(self):
+        """Commits any buffered writes, waits for every batch and returns the write stats."""
+        self._start_batch()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._error is not None:
+            raise self._error
+        latencies = sorted(self._latencies)
+        self.stats['elapsedMs'] = round((time.monotonic() - self._started_at) * 1000)
+        if latencies:
+            self.stats['p50LatencyMs'] = round(latencies[len(latencies) // 2] * 1000)
+            self.stats['p95LatencyMs'] = round(latencies[int(len(latencies) * 0.95)] * 1000)
+            self.stats['maxLatencyMs'] = round(latencies[-1] * 1000)
+        if self._failed_paths:
+            raise RuntimeError(f"{len(self._failed_paths)} Firestore writes failed, e.g. {self._failed_paths[:5]}")
+        return self.stats
+
+    async def _add(self, operation):
+        self._operations.append(operation)
+        if len(self._operations) >= WRITE_BATCH_SIZE:
+            self._start_batch()
+        # Apply backpressure so buffered batches can't grow without bound
+        while len(self._pending) >= SYNC_WRITER_MAX_IN_FLIGHT and self._error is None:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+        if self._error is not None:
+            raise self._error
+
+    def _start_batch(self):
+        if self._operations:
+            task = asyncio.create_task(self._commit(self._operations))
+            self._pending.add(task)
+            task.add_done_callback(self._on_batch_done)
+            self._operations = []
+
+    def _on_batch_done(self, task):
+        self._pending.discard(task)
+        # Finished tasks leave _pending, so keep their exception for _add and close() to raise
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+
+    async def _commit(self, operations):
+        if self._lease is not None and self._lease.lost:
+            raise LeaseLostError("Sync lease was taken over by another invocation; stopping writes")
+        for attempt in range(SYNC_WRITER_MAX_ATTEMPTS):
+            batch = self._client.batch()
+            for kind, doc_ref, data, _ in operations:
+                getattr(batch, kind)(doc_ref, data)
+            started_at = time.monotonic()
+            try:
+                async with self._semaphore:
+                    await batch.commit()
+            except RETRYABLE_WRITE_ERRORS as e:
+                if attempt == SYNC_WRITER_MAX_ATTEMPTS - 1:
+                    error = e
+                    break
+                self.stats['retried'] += 1
+                await asyncio.sleep(random.uniform(0, min(SYNC_WRITER_MAX_BACKOFF, SYNC_WRITER_BASE_BACKOFF * 2 ** attempt)))
+            except exceptions.NotFound as e:
+                if len(operations) == 1 and operations[0][3]:
+                    self.stats['missing'] += 1
+                    return
+                error = e
+                break
+            except exceptions.GoogleAPICallError as e:
+                error = e
+                break
+            else:
+                self._latencies.append(time.monotonic() - started_at)
+                self.stats['batches'] += 1
+                self.stats['succeeded'] += len(operations)
+                return
+
+        if len(operations) > 1:
+            # Retry documents one at a time so a single bad write doesn't fail the whole batch
+            await asyncio.gather(*(self._commit([operation]) for operation in operations))
+            return
+        self.stats['failed'] += 1
+        self._failed_paths.append(operations[0][1].path)
+        print(f"Write to {operations[0][1].path} failed: {error}")
+
+async def update_firestore_optimized(raw_pages, api_key, only_include_primary_photo, manifest_ref,
+                                     async_db, semaphore, shelter_doc_ref, cats_ref, dogs_ref, other_ref, shelterId,
+                                     metrics, lease, full_sync=False):
+    """Diffs and writes parsed animals page by page, then marks animals missing from ShelterLuv as inactive.
 
-    # Function to commit the batch and reset the counter
-    def commit_batch():
-        nonlocal batch, operations_count
-        if operations_count > 0:
-            batch.commit()
-            batch = db.batch()  # Start a new batch
-            operations_count = 0
+    Animals whose fingerprint matches the sync manifest are skipped without reading their document;
+    animals not updated in ShelterLuv since the last sync's high-water mark, and pages ShelterLuv
+    reports as unchanged, aren't parsed at all. If every page is unchanged the manifest is never
+    read and nothing is written. A full sync skips none of this and diffs every animal document.
+    Commits run in the background while later pages are parsed and diffed.
+    """
+    writer = AsyncBatchWriter(async_db, semaphore, lease)
 
     added_animals = []
     updated_animals = []
     removed_animals = []
+    changed_collections = set()  # species collections written to, whose API version is bumped
 
-    # Fetch existing Firestore animals
-    firestore_animals = fetch_firestore_animals(cats_ref, dogs_ref, other_ref)
-    firestore_animals_set = set(firestore_animals)
+    firestore_animals = None  # animal ID -> (collection, fingerprint), loaded once a page has changed
+    high_water_mark = None  # newest LastUpdatedUnixTime seen by the last sync
+    newest_update = 0
+    paging_started_at = None  # ShelterLuv's clock when the first page was served
+    seen_animal_ids = set()
+    synced_animals = {}  # animal ID -> manifest entry for this run
+    deleted_photos_task = None
+    photo_semaphore = asyncio.Semaphore(PHOTO_MIRROR_MAX_CONCURRENT)
 
-    for animal in animals:
-        if not animal['id']:
+    async def load_deleted_photos_index():
+        deleted_photos_index = await fetch_deleted_photos_index(async_db, shelter_doc_ref, semaphore)
+        if deleted_photos_index is not None:
+            metrics.count('firestoreReads', sum(len(urls) for urls in deleted_photos_index.values()) or 1)
+        return deleted_photos_index
+
+    async def sync_page(raw_animals):
+        nonlocal deleted_photos_task, newest_update
+        with metrics.span('parse'):
+            animals = []
+            for raw_animal in raw_animals:
+                last_updated = parse_unix_time(raw_animal.get('LastUpdatedUnixTime'))
+                newest_update = max(newest_update, last_updated or 0)
+                animal_id = raw_animal.get('ID')
+                if high_water_mark and last_updated and last_updated < high_water_mark \
+                        and animal_id not in seen_animal_ids and firestore_animals.get(animal_id, (None, None))[1]:
+                    # Not updated in ShelterLuv since the last sync, so last sync's manifest entry still holds
+                    seen_animal_ids.add(animal_id)
+                    synced_animals[animal_id] = manifest_entry(*firestore_animals[animal_id])
+                    metrics.count('animalsUnchangedSinceHighWaterMark')
+                    continue
+                animals.append(parse_animal(raw_animal, only_include_primary_photo))
+        metrics.count('animals', len(raw_animals))
+
+        # Work out which animals changed since the last sync; only those need their document read
+        changed_animals = []
+        for animal in animals:
+            # Skip animals without an ID and repeats caused by the census shifting between pages
+            if not animal['id'] or animal['id'] in seen_animal_ids:
+                continue
+            seen_animal_ids.add(animal['id'])
+
+            if animal['species'] == 'cat':
+                collection_ref = cats_ref
+            elif animal['species'] == 'dog':
+                collection_ref = dogs_ref
+            else:
+                collection_ref = other_ref
+            fingerprint = fingerprint_animal(animal)
+            synced_animals[animal['id']] = manifest_entry(collection_ref, fingerprint)
+
+            known_collection_ref, known_fingerprint = firestore_animals.get(animal['id'], (None, None))
+            if not full_sync and known_collection_ref is not None and known_collection_ref.id == collection_ref.id \
+                    and known_fingerprint == fingerprint:
+                continue
+            changed_animals.append((animal, collection_ref.document(animal['id']), fingerprint))
+
+        if not changed_animals:
+            return
+        metrics.count('animalsChanged', len(changed_animals))
+
+        with metrics.span('diffReads'):
+            # Deleted photos only matter when writing, so the index is loaded the first time it's needed
+            if deleted_photos_task is None:
+                deleted_photos_task = asyncio.create_task(load_deleted_photos_index())
+            snapshots = await prefetch_animal_docs(async_db, [doc_ref for _, doc_ref, _ in changed_animals], semaphore)
+            metrics.count('firestoreReads', len(snapshots))
+            deleted_photos_index = await deleted_photos_task
+
+        pending_writes = []  # (writer method, doc ref, data), held until their photos are mirrored
+        photo_only_updates = []  # (doc ref, data, animal ID, fingerprint, stored fingerprint), written if a photo mirrors
+        for animal, animal_doc_ref, fingerprint in changed_animals:
+            doc_snapshot = snapshots[animal['id']]
+
+            # Get deleted photos for this animal
+            if deleted_photos_index is not None:
+                deleted_photos = deleted_photos_index.get(animal['id'], set())
+            else:
+                with metrics.span('diffReads'):
+                    async with semaphore:
+                        deleted_photos = {doc.to_dict()['url'] async for doc in animal_doc_ref.collection('deleted_photos').stream()}
+                metrics.count('firestoreReads', len(deleted_photos) or 1)
+
+            if doc_snapshot.exists:
+                existing_data = doc_snapshot.to_dict()
+                update_data = build_animal_update(animal, existing_data, deleted_photos)
+                if SHELTERLUV_MIRROR_PHOTOS:
+                    # Photos synced before mirroring existed are mirrored the next time the animal is diffed
+                    photos = (update_data or {}).get('photos', existing_data.get('photos') or [])
+                    if any(needs_mirroring(p) for p in photos):
+                        if update_data is None:
+                            # Otherwise unchanged, so don't rewrite it every sync if a photo URL is dead
+                            photo_only_updates.append((animal_doc_ref, {'photos': photos}, animal['id'], fingerprint,
+                                                       existing_data.get('shelterluvHash')))
+                            continue
+                        update_data = dict(update_data, photos=photos)
+                if update_data is not None:  # Only update if there's actually a change
+                    update_data['shelterluvHash'] = fingerprint
+                    update_data['updatedAt'] = firestore.SERVER_TIMESTAMP  # for the animals API's updatedSince
+                    pending_writes.append((writer.update, animal_doc_ref, update_data))
+                    updated_animals.append(animal['id'])
+                elif existing_data.get('shelterluvHash') != fingerprint:
+                    # Content already matches; just record the fingerprint so later syncs can skip it
+                    pending_writes.append((writer.update, animal_doc_ref, {'shelterluvHash': fingerprint}))
+            else:
+                # For new animals, filter out any photos that were previously deleted
+                if 'photos' in animal:
+                    animal['photos'] = [p for p in animal['photos'] if p['url'] not in deleted_photos]
+
+                animal['shelterluvHash'] = fingerprint
+                animal['updatedAt'] = firestore.SERVER_TIMESTAMP
+                pending_writes.append((writer.set, animal_doc_ref, animal))  # Set the document if it does not exist
+                added_animals.append(animal['id'])
+
+        if SHELTERLUV_MIRROR_PHOTOS:
+            with metrics.span('photoMirroring'):
+                mirrored_doc_refs = await mirror_photos(
+                    pending_writes + [(writer.update, doc_ref, data) for doc_ref, data, *_ in photo_only_updates],
+                    shelterId, photo_semaphore, metrics
+                )
+        for animal_doc_ref, update_data, animal_id, fingerprint, stored_fingerprint in photo_only_updates:
+            if animal_doc_ref.path in mirrored_doc_refs:
+                update_data['shelterluvHash'] = fingerprint
+                update_data['updatedAt'] = firestore.SERVER_TIMESTAMP
+                pending_writes.append((writer.update, animal_doc_ref, update_data))
+                updated_animals.append(animal_id)
+            elif stored_fingerprint != fingerprint:
+                pending_writes.append((writer.update, animal_doc_ref, {'shelterluvHash': fingerprint}))
+        for write, animal_doc_ref, data in pending_writes:
+            # Remember which ShelterLuv photo each mirror came from, since older app versions record a
+            # deleted photo by its mirrored URL after removing its entry from the doc
+            sources = mirrored_photo_sources(data.get('photos'))
+            if sources and write == writer.set:
+                data['mirroredPhotoSources'] = sources
+            elif sources:
+                data.update({f'mirroredPhotoSources.{content_hash}': url for content_hash, url in sources.items()})
+            await write(animal_doc_ref, data)
+            changed_collections.add(animal_doc_ref.parent.id)
+
+    async def carry_forward_page(page):
+        # An unchanged page was fully synced last time, so its manifest entries still hold
+        animal_ids = [animal_id for animal_id in page['cacheEntry']['animalIds']
+                      if animal_id and animal_id not in seen_animal_ids]
+        if all(firestore_animals.get(animal_id, (None, None))[1] for animal_id in animal_ids):
+            for animal_id in animal_ids:
+                seen_animal_ids.add(animal_id)
+                synced_animals[animal_id] = manifest_entry(*firestore_animals[animal_id])
+            return
+
+        # The manifest no longer covers this page (e.g. it was rebuilt), so diff it in full
+        raw_animals = page['animals']
+        if raw_animals is None:
+            raw_animals = (await asyncio.to_thread(fetch_animals_page, api_key, page['offset'], None, metrics))['animals']
+        await sync_page(raw_animals)
+
+    unchanged_pages = []  # held back until a changed page shows the manifest is needed
+    while True:
+        # Time spent here means the diff is waiting on ShelterLuv
+        with metrics.span('pagingWait'):
+            page = await raw_pages.get()
+        if page is None:
+            break
+        if isinstance(page, Exception):
+            raise page
+
+        metrics.count('pages')
+        if paging_started_at is None:
+            paging_started_at = page.get('servedAt') or int(time.time())
+        if page['unchanged']:
+            metrics.count('pagesUnchanged')
+            if firestore_animals is None:
+                # Don't hold the raw animals; carry_forward_page re-fetches the page if it needs them
+                page['animals'] = None
+                unchanged_pages.append(page)
+            else:
+                await carry_forward_page(page)
             continue
 
-        if animal['species'] == 'cat':
-            collection_ref = cats_ref
-        elif animal['species'] == 'dog':
-            collection_ref = dogs_ref
-        else:
-            collection_ref = other_ref
-        animal_doc_ref = collection_ref.document(animal['id'])
-        doc_snapshot = animal_doc_ref.get()
-        
-        # Get deleted photos for this animal
-        deleted_photos_ref = animal_doc_ref.collection('deleted_photos')
-        deleted_photos = [doc.to_dict()['url'] for doc in deleted_photos_ref.stream()]
-
-        if doc_snapshot.exists:
-            # Fetching the existing data to compare if update is necessary
-            existing_data = doc_snapshot.to_dict()
-            update_data = {key: animal[key] for key in [
-                'name', 'location', 'fullLocation', 'description',
-                'sex', 'monthsOld', 'breed'
-            ] if key in animal}
-
-            # Conditionally update 'photos' if specific criteria are met
-            if 'photos' not in existing_data or len(existing_data['photos']) < 1:
-                update_data['photos'] = animal.get('photos', [])
-            
-            # Filter out deleted photos from the update 
-            if 'photos' in animal:
-                # Keep manually added photos from existing data
-                existing_photos = existing_data.get('photos', [])
-                manually_added_photos = [p for p in existing_photos if p.get('source') == 'manual']
-                
-                # Filter out deleted photos from new ShelterLuv photos 
-                new_shelterluv_photos = [p for p in animal['photos'] if p['url'] not in deleted_photos]
-                
-                # Combine manually added photos with new ShelterLuv photos
-                # This automatically replaces all previous ShelterLuv photos with the new filtered set
-                update_data['photos'] = manually_added_photos + new_shelterluv_photos
-
-            # Check if any of the update fields have actually changed
-            needs_update = False
-            for key, new_value in update_data.items():
-                existing_value = existing_data.get(key)
-                if existing_value != new_value:
-                    needs_update = True
-                    break
+        if firestore_animals is None:
+            with metrics.span('diffReads'):
+                firestore_animals, high_water_mark = await load_known_animals(
+                    manifest_ref, cats_ref, dogs_ref, other_ref, semaphore, only_include_primary_photo, full_sync, metrics
+                )
+            for unchanged_page in unchanged_pages:
+                await carry_forward_page(unchanged_page)
+            unchanged_pages = []
+        await sync_page(page['animals'])
+
+    if firestore_animals is None:
+        print(f"ShelterLuv returned no changed pages for shelter {shelterId}, skipping diff")
+        return
+
+    # Mark removed animals as inactive instead of deleting them, through the same writer as the other writes
+    with metrics.span('markInactive'):
+        animals_to_mark_inactive = firestore_animals.keys() - seen_animal_ids
+        for animal_id in animals_to_mark_inactive:
+            collection_ref, _ = firestore_animals[animal_id]
+            # The doc may have been deleted in the app since the manifest was written; that's as good as inactive
+            await writer.update(collection_ref.document(animal_id), {'isActive': False, 'updatedAt': firestore.SERVER_TIMESTAMP},
+                                ignore_missing=True)
+            removed_animals.append(animal_id)
+            changed_collections.add(collection_ref.id)
 
-            if needs_update:  # Only update if there's actually a change
-                batch.update(animal_doc_ref, update_data)
-                updated_animals.append(animal['id'])
+    # Most batches were committed while later pages were diffed; this waits for the rest
+    with metrics.span('commitWait'):
+        write_stats = await writer.close()
+    print(f"Sync writes for shelter {shelterId}: {write_stats}")
+    metrics.count('firestoreWrites', write_stats['succeeded'])
+    metrics.count('writeBatches', write_stats['batches'])
+    metrics.count('writeRetries', write_stats['retried'])
+
+    with metrics.span('finalize'):
+        # A sync that lost its lease must not overwrite the manifest written by the one that took over
+        await lease.ensure_held()
+        # Only record the manifest once every write has landed, so a failed sync is retried in full
+        known_animals = {animal_id: manifest_entry(collection_ref, fingerprint)
+                         for animal_id, (collection_ref, fingerprint) in firestore_animals.items()}
+        # An animal edited after its page was read may be older than updates seen on later pages, so
+        # the mark never passes the start of paging; an edit after that is picked up next time
+        newest_update = min(newest_update, paging_started_at)
+        # Carried-forward animals are older than the previous mark, so it never moves backwards
+        newest_update = max(newest_update, high_water_mark or 0)
+        if full_sync or synced_animals != known_animals or newest_update != high_water_mark:
+            await manifest_ref.set({
+                'version': MANIFEST_VERSION,
+                'animals': pack_manifest_animals(synced_animals),
+                'highWaterMark': newest_update or None,
+                'onlyIncludePrimaryPhoto': only_include_primary_photo,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+            metrics.count('firestoreWrites')
+
+    # Still delete photos of removed animals to save storage costs
+    async def delete_images(animal_id):
+        async with semaphore:
+            await asyncio.to_thread(delete_images_for_animal, animal_id, shelterId)
+    with metrics.span('imageDeletion'):
+        await asyncio.gather(*(delete_images(animal_id) for animal_id in removed_animals))
+
+    # Store the last sync changes, and bump the version the animals API uses as its ETag
+    with metrics.span('finalize'):
+        await shelter_doc_ref.update({
+            "lastSync": firestore.SERVER_TIMESTAMP,
+            "lastSyncChanges": {
+                "added": added_animals,
+                "updated": updated_animals,
+                "removed": removed_animals  # These are actually marked inactive, not removed
+            },
+            **{f"apiVersions.{collection_id}": firestore.Increment(1) for collection_id in changed_collections}
+        })
+        metrics.count('firestoreWrites')
+
+def build_animal_update(animal, existing_data, deleted_photos):
+    """Returns the fields to update on an existing animal doc, or None if nothing has changed."""
+    update_data = {key: animal[key] for key in [
+        'name', 'location', 'fullLocation', 'description',
+        'sex', 'monthsOld', 'breed'
+    ] if key in animal}
+
+    # Conditionally update 'photos' if specific criteria are met
+    if 'photos' not in existing_data or len(existing_data['photos']) < 1:
+        update_data['photos'] = animal.get('photos', [])
+
+    # Filter out deleted photos from the update
+    if 'photos' in animal:
+        # Keep manually added photos from existing data
+        existing_photos = existing_data.get('photos', [])
+        manually_added_photos = [p for p in existing_photos if p.get('source') == 'manual']
+
+        # Filter out deleted photos from new ShelterLuv photos. Older app versions record the
+        # mirrored URL of a deleted photo, so map those back to the ShelterLuv URL.
+        mirrored_sources = existing_data.get('mirroredPhotoSources') or {}
+        deleted_photos = deleted_photos | {p['sourceUrl'] for p in existing_photos
+                                           if p.get('sourceUrl') and p.get('url') in deleted_photos}
+        deleted_photos = deleted_photos | {mirrored_sources[content_hash] for content_hash in
+                                           map(mirrored_content_hash, deleted_photos) if content_hash in mirrored_sources}
+        new_shelterluv_photos = [p for p in animal['photos'] if p['url'] not in deleted_photos]
+
+        # Combine manually added photos with new ShelterLuv photos
+        # This automatically replaces all previous ShelterLuv photos with the new filtered set
+        update_data['photos'] = manually_added_photos + new_shelterluv_photos
+
+    if 'photos' in update_data:
+        # Keep the stored entry for photos already on the doc so their id and timestamp don't churn
+        existing_photos_by_key = {photo_key(p): p for p in existing_data.get('photos') or []}
+        update_data['photos'] = [existing_photos_by_key.get(photo_key(p), p) for p in update_data['photos']]
+
+    # Check if any of the update fields have actually changed
+    for key, new_value in update_data.items():
+        existing_value = existing_data.get(key)
+        if key == 'photos':
+            changed = [photo_key(p) for p in existing_value or []] != [photo_key(p) for p in new_value]
         else:
-            # For new animals, filter out any photos that were previously deleted
-            if 'photos' in animal:
-                animal['photos'] = [p for p in animal['photos'] if p['url'] not in deleted_photos]
-                
-            batch.set(animal_doc_ref, animal)  # Set the document if it does not exist
-            added_animals.append(animal['id'])
-
-        operations_count += 1
-        if operations_count >= max_batch_size:
-            commit_batch()
-
-    commit_batch()
-    # Mark removed animals as inactive instead of deleting them
-    animals_to_mark_inactive = firestore_animals_set - {animal['id'] for animal in animals if animal['id']}
-    for animal_id in animals_to_mark_inactive:
-        mark_animal_as_inactive_if_exists(animal_id, cats_ref, dogs_ref, other_ref, shelterId)
-        removed_animals.append(animal_id)
-        operations_count += 1
-        if operations_count >= max_batch_size:
-            commit_batch()
-
-    commit_batch()
-
-    # Store the last sync changes
-    shelter_doc_ref.update({
-        "lastSync": firestore.SERVER_TIMESTAMP,
-        "lastSyncChanges": {
-            "added": added_animals,
-            "updated": updated_animals,
-            "removed": removed_animals  # These are actually marked inactive, not removed
-        }
-    })
-
-def mark_animal_as_inactive_if_exists(animal_id, cats_ref, dogs_ref, other_ref, shelterId):
-    """Mark an animal as inactive instead of deleting it, but still delete photos to save storage costs."""
-    cat_doc_ref = cats_ref.document(animal_id)
-    dog_doc_ref = dogs_ref.document(animal_id)
-    other_doc_ref = other_ref.document(animal_id)
-
-    if cat_doc_ref.get().exists:
-        cat_doc_ref.update({'isActive': False})
-        delete_images_for_animal(animal_id, shelterId)
-    elif dog_doc_ref.get().exists:
-        dog_doc_ref.update({'isActive': False})
-        delete_images_for_animal(animal_id, shelterId)
-    elif other_doc_ref.get().exists:
-        other_doc_ref.update({'isActive': False})
-        delete_images_for_animal(animal_id, shelterId)
+            changed = existing_value != new_value
+        if changed:
+            return update_data
+    return None
+
+def parse_unix_time(value):
+    """ShelterLuv sends unix times as strings; returns None for anything that isn't one."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def fingerprint_animal(animal):
+    """Hashes the ShelterLuv-sourced fields of a parsed animal so unchanged animals can be skipped."""
+    sourced_fields = {key: animal.get(key) for key in FINGERPRINT_FIELDS}
+    sourced_fields['photos'] = [photo['url'] for photo in animal.get('photos', [])]
+    encoded = json.dumps(sourced_fields, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+def manifest_entry(collection_ref, fingerprint):
+    """Compact manifest value recording where an animal lives and what was last synced."""
+    return f"{collection_ref.id}:{fingerprint}"
+
+def pack_manifest_animals(animals):
+    """Packs the manifest's animal ID -> entry map into one compressed value. As a map, every
+    animal would be an indexed field, and large shelters would pass the per-document index entry limit."""
+    return zlib.compress(json.dumps(animals, separators=(',', ':')).encode('utf-8'))
+
+def unpack_manifest_animals(value):
+    """Reverses pack_manifest_animals; manifests written before packing store a plain map."""
+    if isinstance(value, bytes):
+        return json.loads(zlib.decompress(value))
+    return value or {}
+
+def photo_key(photo):
+    """Identifies a photo by its ShelterLuv URL and source, ignoring per-run fields and mirroring."""
+    return (photo.get('sourceUrl') or photo.get('url'), photo.get('source'))
+
+def mirrored_photo_sources(photos):
+    """Maps the content hash of each mirrored photo to the ShelterLuv URL it was mirrored from."""
+    return {p['contentHash']: p['sourceUrl'] for p in photos or [] if p.get('contentHash') and p.get('sourceUrl')}
+
+def mirrored_content_hash(url):
+    """The content hash in a mirrored photo's URL, or None for any other URL."""
+    match = MIRRORED_PHOTO_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+def needs_mirroring(photo):
+    return photo.get('source') == 'shelterluv' and not photo.get('sourceUrl')
+
+async def mirror_photos(pending_writes, shelterId, photo_semaphore, metrics):
+    """Mirrors the not-yet-mirrored ShelterLuv photos of the pending writes into storage, in place,
+    and returns the paths of the docs that had at least one photo mirrored.
+
+    Photos that fail to mirror keep their ShelterLuv URL and are retried the next time the animal is diffed.
+    """
+    mirrored_doc_refs = set()
+
+    async def mirror(animal_doc_ref, photos, index):
+        async with photo_semaphore:
+            mirrored = await asyncio.to_thread(mirror_photo, photos[index], shelterId, animal_doc_ref.id)
+        if mirrored is None:
+            metrics.count('photoMirrorFailures')
+            return
+        photos[index] = mirrored
+        mirrored_doc_refs.add(animal_doc_ref.path)
+        metrics.count('photosMirrored')
+
+    await asyncio.gather(*(
+        mirror(animal_doc_ref, data['photos'], index)
+        for _, animal_doc_ref, data in pending_writes
+        for index, photo in enumerate(data.get('photos') or [])
+        if needs_mirroring(photo)
+    ))
+    return mirrored_doc_refs
+
+def mirror_photo(photo, shelterId, animal_id):
+    """Downloads a ShelterLuv photo and stores its resized variants. Returns the updated photo entry, or None."""
+    try:
+        response = shelterluv_session.get(photo['url'], timeout=SHELTERLUV_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        content_hash = hashlib.sha256(response.content).hexdigest()[:32]
+        bucket = storage_client.bucket(STORAGE_BUCKET)
+        image = None
+        variants = {}
+        for size in PHOTO_VARIANT_SIZES:
+            name = f"{shelterId}/{animal_id}/shelterluv_{content_hash}_{size}x{size}"
+            blob = bucket.get_blob(name)
+            if blob is None:
+                if image is None:
+                    image = ImageOps.exif_transpose(Image.open(io.BytesIO(response.content))).convert('RGB')
+                blob = upload_photo_variant(bucket, name, image, size)
+            variants[f"{size}x{size}"] = photo_download_url(blob)
+    except Exception as e:
+        print(f"Failed to mirror photo {photo['url']} for animal {animal_id}: {e}")
+        return None
+    return dict(photo, url=variants[PHOTO_DISPLAY_SIZE], sourceUrl=photo['url'],
+                contentHash=content_hash, variants=variants)
+
+def upload_photo_variant(bucket, name, image, size):
+    """Uploads a JPEG resized to fit size x size, keeping the existing object if another sync got there first."""
+    variant = image.copy()
+    variant.thumbnail((size, size))
+    buffer = io.BytesIO()
+    variant.save(buffer, format='JPEG', quality=PHOTO_JPEG_QUALITY, optimize=True)
+
+    blob = bucket.blob(name)
+    # Firebase download URLs are authorized by this token, like the app's own uploads
+    blob.metadata = {'firebaseStorageDownloadTokens': uuid.uuid4().hex}
+    blob.cache_control = 'public, max-age=31536000, immutable'
+    try:
+        blob.upload_from_string(buffer.getvalue(), content_type='image/jpeg', if_generation_match=0)
+    except exceptions.PreconditionFailed:
+        blob = bucket.get_blob(name)
+    return blob
+
+def photo_download_url(blob):
+    token = (blob.metadata or {}).get('firebaseStorageDownloadTokens', '').split(',')[0]
+    if not token:
+        raise ValueError(f"{blob.name} has no download token")
+    return (f"https://firebasestorage.googleapis.com/v0/b/{blob.bucket.name}/o/"
+            f"{quote(blob.name, safe='')}?alt=media&token={token}")
 
 def delete_images_for_animal(animal_id, shelterId):
-    """Deletes all images for a given animal from Firebase Storage based on the animal's ID."""
-    bucket = storage_client.get_bucket('production-10b3e.firebasestorage.app')
+    """Deletes all images for a given animal from Firebase Storage based on the animal's ID.
+
+    Mirrored ShelterLuv photos are kept: the inactive animal's doc still points at them, and the
+    animals API keeps serving inactive animals.
+    """
+    bucket = storage_client.bucket(STORAGE_BUCKET)
     images_prefix = f'{shelterId}/{animal_id}/'
 
     blobs = bucket.list_blobs(prefix=images_prefix)
     for blob in blobs:
+        if blob.name.startswith(f'{images_prefix}shelterluv_'):
+            continue
         blob.delete()
 
-def fetch_firestore_animals(cats_ref, dogs_ref, other_ref):
-    """Fetches IDs of all active animals in Firestore for cats, dogs, and other animals"""
-    firestore_animals = []
-    # Only fetch active animals for comparison
-    for doc in cats_ref.where('isActive', '==', True).stream():
-        firestore_animals.append(doc.id)
-    for doc in dogs_ref.where('isActive', '==', True).stream():
-        firestore_animals.append(doc.id)
-    for doc in other_ref.where('isActive', '==', True).stream():
-        firestore_animals.append(doc.id)
+async def prefetch_animal_docs(async_db, doc_refs, semaphore):
+    """Loads the given animal docs with concurrent, chunked get_all calls and returns a map of animal ID to snapshot."""
+    async def fetch_chunk(chunk):
+        async with semaphore:
+            return [snapshot async for snapshot in async_db.get_all(chunk)]
+
+    chunks = await asyncio.gather(*(
+        fetch_chunk(doc_refs[start:start + PREFETCH_CHUNK_SIZE])
+        for start in range(0, len(doc_refs), PREFETCH_CHUNK_SIZE)
+    ))
+    return {snapshot.id: snapshot for chunk in chunks for snapshot in chunk}
+
+async def fetch_deleted_photos_index(async_db, shelter_doc_ref, semaphore):
+    """Builds a map of animal ID to deleted photo URLs with one collection group query scoped to the shelter.
+    Returns None if the query fails so callers can fall back to reading each animal's subcollection."""
+    shelter_path_end = async_db.collection('shelters').document(shelter_doc_ref.id + '\uf8ff')
+    query = (async_db.collection_group('deleted_photos')
+             .where('__name__', '>=', shelter_doc_ref)
+             .where('__name__', '<', shelter_path_end))
+
+    deleted_photos_index = {}
+    try:
+        async with semaphore:
+            async for doc in query.stream():
+                animal_doc_ref = doc.reference.parent.parent
+                # Guard against shelter IDs that share a prefix with this one
+                if animal_doc_ref.parent.parent.id != shelter_doc_ref.id:
+                    continue
+                url = doc.to_dict().get('url')
+                if url:
+                    deleted_photos_index.setdefault(animal_doc_ref.id, set()).add(url)
+    except Exception as e:
+        print(f"Error fetching deleted photos index for shelter {shelter_doc_ref.id}: {e}")
+        return None
+    return deleted_photos_index
+
+async def fetch_firestore_animals(cats_ref, dogs_ref, other_ref, semaphore):
+    """Fetches IDs of all active animals in Firestore for cats, dogs, and other animals,
+    mapped to their collection and stored fingerprint"""
+    # Only fetch active animals for comparison, and only the fields we need
+    async def fetch_active_animals(collection_ref):
+        async with semaphore:
+            query = collection_ref.where('isActive', '==', True).select(['isActive', 'shelterluvHash'])
+            # Animals synced before fingerprints existed have no shelterluvHash yet
+            return [(doc.id, (doc.to_dict() or {}).get('shelterluvHash')) async for doc in query.stream()]
+
+    collection_refs = (cats_ref, dogs_ref, other_ref)
+    species_animals = await asyncio.gather(*(fetch_active_animals(ref) for ref in collection_refs))
+    firestore_animals = {}
+    for collection_ref, animals in zip(collection_refs, species_animals):
+        for animal_id, fingerprint in animals:
+            firestore_animals[animal_id] = (collection_ref, fingerprint)
     return firestore_animals
 
-def fetch_all_animals(api_key):
-    url = "https://www.shelterluv.com/api/v1/animals?status_type=in custody"
+async def fetch_sync_manifest(manifest_ref, cats_ref, dogs_ref, other_ref, semaphore, only_include_primary_photo=True):
+    """Reads the per-shelter sync manifest in the same shape as fetch_firestore_animals, plus its
+    high-water mark. Returns None if there is no manifest or it was written by an older fingerprint
+    version. The high-water mark is None if the photo setting changed since it was recorded."""
+    try:
+        async with semaphore:
+            manifest_doc = await manifest_ref.get()
+    except Exception as e:
+        print(f"Error fetching sync manifest: {e}")
+        return None, None
+    if not manifest_doc.exists or manifest_doc.get('version') != MANIFEST_VERSION:
+        return None, None
+
+    collection_refs = {ref.id: ref for ref in (cats_ref, dogs_ref, other_ref)}
+    firestore_animals = {}
+    manifest_data = manifest_doc.to_dict()
+    for animal_id, entry in unpack_manifest_animals(manifest_data.get('animals')).items():
+        collection_id, _, fingerprint = entry.partition(':')
+        if collection_id in collection_refs:
+            firestore_animals[animal_id] = (collection_refs[collection_id], fingerprint)
+
+    high_water_mark = manifest_data.get('highWaterMark')
+    if manifest_data.get('onlyIncludePrimaryPhoto') != only_include_primary_photo:
+        high_water_mark = None
+    return firestore_animals, high_water_mark
+
+async def load_known_animals(manifest_ref, cats_ref, dogs_ref, other_ref, semaphore,
+                             only_include_primary_photo=True, full_sync=False, metrics=None):
+    """Maps active animal IDs to their collection and fingerprint, from the manifest when it's usable,
+    and returns the manifest's high-water mark alongside. A full sync always reads the animals themselves."""
+    firestore_animals, high_water_mark = None, None
+    if not full_sync:
+        firestore_animals, high_water_mark = await fetch_sync_manifest(
+            manifest_ref, cats_ref, dogs_ref, other_ref, semaphore, only_include_primary_photo
+        )
+        if metrics:
+            metrics.count('firestoreReads')
+    if firestore_animals is None:
+        # No usable manifest yet, so rebuild the picture from the active animals themselves
+        firestore_animals = await fetch_firestore_animals(cats_ref, dogs_ref, other_ref, semaphore)
+        high_water_mark = None
+        if metrics:
+            metrics.count('firestoreReads', len(firestore_animals))
+    return firestore_animals, high_water_mark
+
+def fetch_animals_page(api_key, offset, cached=None, metrics=None):
+    """Fetches one page of in-custody animals, retrying 429/5xx responses and network errors with jittered backoff.
+
+    Given the page's `cached` entry from the last sync, the request is sent as a conditional GET and
+    the page is marked unchanged on a 304 (with `animals` left as None) or when the body hashes the same.
+    """
     headers = {"X-Api-Key": api_key}
-    params = {"limit": 100, "offset": 0}
-    all_original_animals = []
-    all_animals = []
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('lastModified'):
+            headers['If-Modified-Since'] = cached['lastModified']
+    params = {"status_type": "in custody", "limit": SHELTERLUV_PAGE_SIZE, "offset": offset}
 
-    while True:
-        response = requests.get(url, headers=headers, params=params)
+    for attempt in range(SHELTERLUV_MAX_RETRIES + 1):
+        retry_after = None
         try:
-            response.raise_for_status()
-        except Exception as e:
-            raise
-        data = response.json()
+            with metrics.span('paging') if metrics else nullcontext():
+                response = shelterluv_session.get(
+                    SHELTERLUV_ANIMALS_URL, headers=headers, params=params, timeout=SHELTERLUV_REQUEST_TIMEOUT
+                )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == SHELTERLUV_MAX_RETRIES:
+                raise
+            print(f"ShelterLuv request for offset {offset} failed ({e}), retrying")
+        else:
+            if metrics:
+                metrics.count('httpRequests')
+                metrics.count('bytes', len(response.content))
+            if response.status_code == 304 and cached:
+                return {'offset': offset, 'animals': None, 'unchanged': True, 'cacheEntry': cached,
+                        'servedAt': response_unix_time(response)}
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == SHELTERLUV_MAX_RETRIES:
+                response.raise_for_status()
+                return read_animals_page(offset, response, cached)
+            print(f"ShelterLuv returned {response.status_code} for offset {offset}, retrying")
+            if metrics:
+                metrics.count('httpRetries')
+            retry_after = response.headers.get('Retry-After')
 
-        animals = data.get('animals')
-        if not animals:  # Break the loop if no animals are returned
-            break
+        # Full jitter backoff, but never retry sooner than the server asked us to
+        delay = random.uniform(0, min(SHELTERLUV_MAX_BACKOFF, SHELTERLUV_BASE_BACKOFF * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+def read_animals_page(offset, response, cached=None):
+    """Builds the page record for a full response, along with the cache entry describing it."""
+    body = response.json()
+    animals = body.get('animals') or []
+    cache_entry = {
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'bodyHash': hashlib.sha256(response.content).hexdigest(),
+        'totalCount': body.get('total_count'),
+        'animalIds': [animal.get('ID') for animal in animals],
+    }
+    unchanged = cached is not None and cached.get('bodyHash') == cache_entry['bodyHash']
+    return {'offset': offset, 'animals': animals, 'unchanged': unchanged, 'cacheEntry': cache_entry,
+            'servedAt': response_unix_time(response)}
+
+def response_unix_time(response):
+    """The response's Date header as a unix time, or None if it's missing or malformed."""
+    try:
+        return int(parsedate_to_datetime(response.headers['Date']).timestamp())
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def iter_animal_pages(api_key, page_cache=None, metrics=None, max_concurrent_pages=SHELTERLUV_MAX_CONCURRENT_PAGES):
+    """Yields pages of in-custody animals in offset order.
+
+    The first page is fetched on its own to read `total_count`; the remaining offsets are then
+    fetched with up to `max_concurrent_pages` requests in flight. If the census grows while paging,
+    any extra pages are picked up sequentially until a short page is returned. The first page is
+    always yielded, even when empty, so an emptied census still reaches the diff.
+    """
+    def fetch_page(offset):
+        cached = page_cache.get(offset) if page_cache is not None else None
+        page = fetch_animals_page(api_key, offset, cached, metrics)
+        if page_cache is not None:
+            page_cache.stage(offset, page['cacheEntry'])
+        return page
+
+    page = fetch_page(0)
+    yield page
+    page_size = len(page['cacheEntry']['animalIds'])
+    if not page_size:
+        return
+
+    last_page_full = page_size >= SHELTERLUV_PAGE_SIZE
+    next_offset = SHELTERLUV_PAGE_SIZE
+    total_count = page['cacheEntry']['totalCount']
+
+    if last_page_full and total_count is not None:
+        offsets = range(SHELTERLUV_PAGE_SIZE, int(total_count), SHELTERLUV_PAGE_SIZE)
+        remaining_offsets = iter(offsets)
+        with ThreadPoolExecutor(max_workers=max_concurrent_pages) as executor:
+            # Run each fetch in a copy of this context so its trace span keeps the sync as its parent
+            pending = deque(
+                executor.submit(contextvars.copy_context().run, fetch_page, offset)
+                for offset in islice(remaining_offsets, max_concurrent_pages)
+            )
+            while pending:
+                page = pending.popleft().result()
+                offset = next(remaining_offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(contextvars.copy_context().run, fetch_page, offset))
 
-        all_animals.extend(animals)  # Keep raw animals
-        all_original_animals.extend(animals)
-        params["offset"] += params["limit"]
+                page_size = len(page['cacheEntry']['animalIds'])
+                last_page_full = page_size >= SHELTERLUV_PAGE_SIZE
+                if page_size:
+                    yield page
+        next_offset = max(next_offset, offsets.stop + (-offsets.stop % SHELTERLUV_PAGE_SIZE))
 
-    return all_animals, all_original_animals
+    while last_page_full:
+        page = fetch_page(next_offset)
+        page_size = len(page['cacheEntry']['animalIds'])
+        last_page_full = page_size >= SHELTERLUV_PAGE_SIZE
+        if page_size:
+            yield page
+        next_offset += SHELTERLUV_PAGE_SIZE
 
 def parse_animal(animal, only_include_primary_photo=True):
     timestamp = datetime.now()
@@ -290,7 +1300,8 @@ def parse_animal(animal, only_include_primary_photo=True):
             photo_urls = [photo_urls[0]]  # Only the first photo (primary/cover photo)
             
         for photo_url in photo_urls:
-            photo_id = str(uuid.uuid4())
+            # Derive the id from the URL so the same ShelterLuv photo keeps its id across syncs
+            photo_id = str(uuid.uuid5(uuid.NAMESPACE_URL, photo_url))
             photos.append({
                 'id': photo_id,
                 'url': photo_url,
@@ -0,0 +1,210 @@
+"""Unit tests for the ShelterLuv sync. Run with `python -m pytest` from this directory."""
+import asyncio
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+
+with mock.patch('google.cloud.storage.Client'):
+    import main
+
+def snapshot(doc_id, data):
+    reference = mock.Mock(id=doc_id)
+    return DocumentSnapshot(reference, data, True, None, None, None)
+
+def collection_returning(collection_id, docs):
+    """A collection ref mock whose active-animals query streams `docs`."""
+    async def stream():
+        for doc in docs:
+            yield doc
+    collection_ref = mock.Mock(id=collection_id)
+    collection_ref.where.return_value.select.return_value.stream = stream
+    return collection_ref
+
+class FetchFirestoreAnimalsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_animals_synced_before_fingerprints_have_no_hash(self):
+        cats_ref = collection_returning('cats', [snapshot('1', {'isActive': True}),
+                                                 snapshot('2', {'isActive': True, 'shelterluvHash': 'abc'})])
+        dogs_ref = collection_returning('dogs', [])
+        other_ref = collection_returning('other', [])
+
+        animals = await main.fetch_firestore_animals(cats_ref, dogs_ref, other_ref, asyncio.Semaphore(1))
+
+        self.assertEqual(animals, {'1': (cats_ref, None), '2': (cats_ref, 'abc')})
+
+class FetchSyncManifestTest(unittest.IsolatedAsyncioTestCase):
+    async def fetch(self, animals):
+        manifest_ref = mock.Mock()
+        manifest_ref.get = mock.AsyncMock(return_value=snapshot('shelterluv_manifest', {
+            'version': main.MANIFEST_VERSION, 'animals': animals, 'highWaterMark': 5, 'onlyIncludePrimaryPhoto': True
+        }))
+        refs = [mock.Mock(id=collection_id) for collection_id in ('cats', 'dogs', 'other')]
+        animals, high_water_mark = await main.fetch_sync_manifest(manifest_ref, *refs, asyncio.Semaphore(1))
+        return {animal_id: (ref.id, fingerprint) for animal_id, (ref, fingerprint) in animals.items()}, high_water_mark
+
+    async def test_reads_packed_and_legacy_manifests(self):
+        entries = {'1': 'cats:abc', '2': 'dogs:def'}
+        expected = ({'1': ('cats', 'abc'), '2': ('dogs', 'def')}, 5)
+
+        self.assertEqual(await self.fetch(main.pack_manifest_animals(entries)), expected)
+        self.assertEqual(await self.fetch(entries), expected)
+
+class HighWaterMarkTest(unittest.IsolatedAsyncioTestCase):
+    """Animals last updated in ShelterLuv before the previous sync's high-water mark aren't parsed."""
+
+    def raw_animal(self, animal_id, last_updated, name='Luna'):
+        return {'ID': animal_id, 'Type': 'Cat', 'Name': name, 'Sex': 'Female', 'LastUpdatedUnixTime': str(last_updated)}
+
+    def fingerprint(self, raw_animal):
+        return main.fingerprint_animal(main.parse_animal(raw_animal))
+
+    async def sync(self, pages, manifest_animals, high_water_mark, only_include_primary_photo=True):
+        """Runs update_firestore_optimized over `pages` of (servedAt, raw animals) against a manifest.
+
+        Returns the IDs of the animals that were parsed and the manifest that was written, if any.
+        """
+        raw_pages = asyncio.Queue()
+        for offset, (served_at, raw_animals) in enumerate(pages):
+            raw_pages.put_nowait({'offset': offset, 'unchanged': False, 'animals': raw_animals, 'servedAt': served_at})
+        raw_pages.put_nowait(None)
+
+        manifest_ref = mock.Mock(set=mock.AsyncMock())
+        manifest_ref.get = mock.AsyncMock(return_value=snapshot('shelterluv_manifest', {
+            'version': main.MANIFEST_VERSION, 'animals': main.pack_manifest_animals(manifest_animals),
+            'highWaterMark': high_water_mark, 'onlyIncludePrimaryPhoto': True
+        }))
+        async_db = mock.Mock()
+        async_db.batch.return_value.commit = mock.AsyncMock()
+        refs = [mock.Mock(id=collection_id) for collection_id in ('cats', 'dogs', 'other')]
+
+        async def prefetch_animal_docs(async_db, doc_refs, semaphore):
+            # Every animal that needs writing is new
+            return {doc_ref.id: DocumentSnapshot(doc_ref, None, False, None, None, None) for doc_ref in doc_refs}
+        for ref in refs:
+            ref.document.side_effect = lambda animal_id, ref=ref: mock.Mock(id=animal_id, path=f'{ref.id}/{animal_id}', parent=ref)
+
+        with mock.patch.object(main, 'parse_animal', wraps=main.parse_animal) as parse_animal, \
+                mock.patch.object(main, 'prefetch_animal_docs', prefetch_animal_docs), \
+                mock.patch.object(main, 'fetch_deleted_photos_index', mock.AsyncMock(return_value={})), \
+                mock.patch.object(main, 'SHELTERLUV_MIRROR_PHOTOS', False):
+            await main.update_firestore_optimized(
+                raw_pages, 'key', only_include_primary_photo, manifest_ref, async_db, asyncio.Semaphore(1),
+                mock.Mock(id='S', update=mock.AsyncMock()), *refs, 'S', main.SyncMetrics(),
+                mock.Mock(lost=False, ensure_held=mock.AsyncMock())
+            )
+
+        parsed_ids = [call.args[0]['ID'] for call in parse_animal.call_args_list]
+        written_manifest = manifest_ref.set.call_args.args[0] if manifest_ref.set.called else None
+        return parsed_ids, written_manifest
+
+    async def test_skips_only_animals_older_than_the_mark_with_a_manifest_fingerprint(self):
+        unchanged = self.raw_animal('1', 50)
+        unhashed = self.raw_animal('2', 50)
+        new = self.raw_animal('3', 50)
+        recent = self.raw_animal('4', 150)
+        at_mark = self.raw_animal('5', 100)
+        manifest_animals = {'1': f"cats:{self.fingerprint(unchanged)}", '2': 'cats:',
+                            '4': f"cats:{self.fingerprint(recent)}", '5': f"cats:{self.fingerprint(at_mark)}"}
+
+        parsed_ids, manifest = await self.sync([(200, [unchanged, unhashed, new, recent, at_mark])], manifest_animals, 100)
+
+        self.assertEqual(parsed_ids, ['2', '3', '4', '5'])
+        # The skipped animal's entry is carried into the new manifest
+        self.assertEqual(main.unpack_manifest_animals(manifest['animals'])['1'], manifest_animals['1'])
+        self.assertEqual(manifest['highWaterMark'], 150)
+
+    async def test_mark_is_capped_at_the_first_page_so_animals_edited_mid_paging_are_synced_next_time(self):
+        edited = self.raw_animal('1', 900)
+        later = self.raw_animal('2', 1050)
+        manifest_animals = {'1': f"cats:{self.fingerprint(edited)}", '2': f"cats:{self.fingerprint(later)}"}
+
+        # '1' was edited at 1040, after its page was served at 1000; '2' was edited at 1050, before its page
+        _, manifest = await self.sync([(1000, [edited]), (1100, [later])], manifest_animals, None)
+        self.assertEqual(manifest['highWaterMark'], 1000)
+
+        edited = self.raw_animal('1', 1040, name='Luna Belle')
+        parsed_ids, manifest = await self.sync([(2000, [edited, later])], manifest_animals, 1000)
+        self.assertEqual(parsed_ids, ['1', '2'])
+        self.assertEqual(main.unpack_manifest_animals(manifest['animals'])['1'], f"cats:{self.fingerprint(edited)}")
+
+    async def test_mark_never_moves_backwards(self):
+        unchanged = self.raw_animal('1', 300)
+        new = self.raw_animal('2', 400)
+
+        parsed_ids, manifest = await self.sync([(1000, [unchanged, new])], {'1': f"cats:{self.fingerprint(unchanged)}"}, 500)
+
+        self.assertEqual(parsed_ids, ['2'])
+        self.assertEqual(manifest['highWaterMark'], 500)
+
+    async def test_changing_the_photo_setting_resets_the_mark(self):
+        unchanged = self.raw_animal('1', 50)
+
+        parsed_ids, _ = await self.sync([(200, [unchanged])], {'1': f"cats:{self.fingerprint(unchanged)}"}, 100,
+                                        only_include_primary_photo=False)
+
+        self.assertEqual(parsed_ids, ['1'])
+
+class BuildAnimalUpdateTest(unittest.TestCase):
+    def test_photo_deleted_by_mirrored_url_stays_deleted_after_its_entry_is_removed(self):
+        source_url = 'https://shelterluv.invalid/photo.jpg'
+        content_hash = 'ab' * 16
+        mirrored_url = (f"https://firebasestorage.googleapis.com/v0/b/bucket/o/S%2F1%2Fshelterluv_{content_hash}_750x750"
+                        "?alt=media&token=t")
+        animal = {'name': 'Luna', 'photos': [{'id': 'p1', 'url': source_url, 'source': 'shelterluv'}]}
+        # An older app removed the mirrored photo from the doc and recorded its mirrored URL as deleted
+        existing_data = {'name': 'Luna', 'photos': [], 'mirroredPhotoSources': {content_hash: source_url}}
+
+        self.assertIsNone(main.build_animal_update(animal, existing_data, {mirrored_url}))
+        self.assertEqual(main.build_animal_update(animal, existing_data, set())['photos'], animal['photos'])
+
+class DeleteImagesForAnimalTest(unittest.TestCase):
+    def test_keeps_mirrored_shelterluv_photos(self):
+        blobs = [mock.Mock(), mock.Mock()]
+        blobs[0].name = 'S/1/photo_750x750'
+        blobs[1].name = f"S/1/shelterluv_{'ab' * 16}_750x750"
+        main.storage_client.bucket.return_value.list_blobs.return_value = blobs
+
+        main.delete_images_for_animal('1', 'S')
+
+        blobs[0].delete.assert_called_once()
+        blobs[1].delete.assert_not_called()
+
+class AsyncBatchWriterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_close_raises_errors_from_batches_that_already_finished(self):
+        client = mock.Mock()
+        client.batch.return_value.commit = mock.AsyncMock(side_effect=exceptions.RetryError('timed out', None))
+        writer = main.AsyncBatchWriter(client, asyncio.Semaphore(1))
+
+        for n in range(500):
+            await writer.update(mock.Mock(path=f'animals/{n}'), {'isActive': False})
+        await asyncio.sleep(0.01)  # let both batches fail before close() is called
+
+        with self.assertRaises(exceptions.RetryError):
+            await writer.close()
+
+    async def test_updates_ignoring_missing_docs_succeed_when_the_doc_was_deleted(self):
+        batches = []
+        def batch():
+            operations = []
+            async def commit():
+                if any(doc_ref.path == 'animals/deleted' for doc_ref in operations):
+                    raise exceptions.NotFound('no entity to update')
+            batches.append(operations)
+            return mock.Mock(update=lambda doc_ref, data: operations.append(doc_ref), commit=commit)
+        client = mock.Mock(batch=batch)
+        writer = main.AsyncBatchWriter(client, asyncio.Semaphore(1))
+
+        await writer.update(mock.Mock(path='animals/active'), {'isActive': False}, ignore_missing=True)
+        await writer.update(mock.Mock(path='animals/deleted'), {'isActive': False}, ignore_missing=True)
+        stats = await writer.close()
+
+        self.assertEqual((stats['succeeded'], stats['missing'], stats['failed']), (1, 1, 0))
+
+        writer = main.AsyncBatchWriter(client, asyncio.Semaphore(1))
+        await writer.update(mock.Mock(path='animals/deleted'), {'name': 'Luna'})
+        with self.assertRaises(RuntimeError):
+            await writer.close()
+
+if __name__ == '__main__':
+    unittest.main()
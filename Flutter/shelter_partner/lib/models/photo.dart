@@ -8,6 +8,8 @@ class Photo {
   final String author;
   final String authorID;
   final String source;
+  // Original ShelterLuv URL for photos the sync has mirrored into storage
+  final String? sourceUrl;
 
   Photo({
     required this.id,
@@ -16,6 +18,7 @@ class Photo {
     required this.author,
     required this.authorID,
     this.source = 'manual', // Default to manual for backward compatibility
+    this.sourceUrl,
   });
 
   factory Photo.fromMap(Map<String, dynamic> data) {
@@ -26,6 +29,7 @@ class Photo {
       author: data['author'] ?? "Unknown",
       authorID: data['authorID'] ?? "Unknown",
       source: data['source'] ?? 'manual', // Handle missing source field
+      sourceUrl: data['sourceUrl'],
     );
   }
 
@@ -37,6 +41,7 @@ class Photo {
       'author': author,
       'authorID': authorID,
       'source': source,
+      if (sourceUrl != null) 'sourceUrl': sourceUrl,
     };
   }
 
@@ -47,6 +52,7 @@ class Photo {
     String? author,
     String? authorID,
     String? source,
+    String? sourceUrl,
   }) {
     return Photo(
       id: id ?? this.id,
@@ -55,6 +61,7 @@ class Photo {
       author: author ?? this.author,
       authorID: authorID ?? this.authorID,
       source: source ?? this.source,
+      sourceUrl: sourceUrl ?? this.sourceUrl,
     );
   }
 }
@@ -94,7 +94,8 @@ class EditAnimalRepository {
     else if (photo.source == 'shelterluv' || photo.source == 'asm') {
       try {
         await animalRef.collection('deleted_photos').add({
-          'url': photo.url,
+          // The sync matches deleted photos against ShelterLuv's URL, not the mirrored copy
+          'url': photo.sourceUrl ?? photo.url,
           'deletedAt': Timestamp.now(),
           'source': photo.source,
         });